@@ -1,28 +1,28 @@
 import sys
 import random
+from collections import deque
 from math import ceil
-from Model import Constants
+from Model import Block, Constants
+from Planner import DistanceField, DistanceFields, PathCache, PathSearch, Reachability, ThreatMap, \
+    TargetAssignment, DirectionOrder
+from ParallelPlanner import ParallelPlanner
+from Metrics import metrics
 
 
 
 class AI():
     DIRECTIONS = Constants.DIRECTIONS[:]
-    REVERSE_DIRECTIONS = {
-        Constants.Directions.NORTH: Constants.Directions.SOUTH,
-        Constants.Directions.SOUTH: Constants.Directions.NORTH,
-        Constants.Directions.NORTH_EAST: Constants.Directions.SOUTH_WEST,
-        Constants.Directions.SOUTH_WEST: Constants.Directions.NORTH_EAST,
-        Constants.Directions.NORTH_WEST: Constants.Directions.SOUTH_EAST,
-        Constants.Directions.SOUTH_EAST: Constants.Directions.NORTH_WEST
-    }
 
     MIN_ATTACK_VALUE = 20
     MAX_ATTACK_VALUE = 35
     AVERAGE_ATTACK_VALUE = (20 + 35) / 2
+    # attack when win_probability is at least this
+    ATTACK_WIN_THRESHOLD = -1
 
     # MAX_TURNS_TO_KILL = 5
 
     class Node:
+        __slots__ = ('block', 'parent', 'direction')
 
         def __init__(self, block, parent_block, direction):
             self.block = block
@@ -30,13 +30,14 @@ class AI():
             self.direction = direction
 
         def __str__(self):
-            return str(self.block.pos["x"]) + " " + str(self.block.pos["y"])
+            pos = self.block.pos
+            return str(pos["x"]) + " " + str(pos["y"])
 
         def __eq__(self, other):
             return self.block == other.block
 
         def __hash__(self):
-            return hash((self.block.pos["x"], self.block.pos["y"], self.direction))
+            return self.block.index
 
     @staticmethod
     def get_average_attack_value(world):
@@ -47,25 +48,30 @@ class AI():
         else:
             return (AI.MAX_ATTACK_VALUE - 5)
 
-    def random_walk(self, world, cell, fully_random=False):
+    def random_walk(self, world, cell, fully_random=False, cheap=False):
         #print("== random_walk()")
-        my_cell_poses = {
-            (my_cell.pos['x'], my_cell.pos['y']) for my_cell in world.my_cells.values()}
-        random.shuffle(AI.DIRECTIONS)
-
-        for direction in Constants.DIRECTIONS:
-            next_pos = world.map.get_next_pos(direction, cell.pos)
-            if (next_pos['x'], next_pos['y']) in my_cell_poses:
+        started = metrics.clock()
+        self.walk_randomly(world, cell, fully_random, cheap)
+        metrics.add('ai.random_walk', started)
+
+    def walk_randomly(self, world, cell, fully_random, cheap):
+        block = world.map.block_at(cell.index)
+        for direction, next_index in world.map.neighbors_of(block.index):
+            next_block = world.map.block_at(next_index)
+            if next_block is None:
+                continue
+            if world.my_cell_at(next_index) is not None:
                 continue
 
-            if not AI.is_in_bounds(world, next_pos) or not AI.get_next_to_pos(world, cell, world.map.at(next_pos), world.map.at(cell.pos)):
+            # cheap walks skip the search for a way back
+            if not cheap and not self.can_reach(world, cell, next_block, block):
                 continue
 
             if (fully_random or
-                not self.visited[next_pos['x']][next_pos['y']]) \
-                    and AI.is_move_possible(world.map.at(cell.pos), world.map.at(next_pos), cell):
+                not self.is_visited(next_index)) \
+                    and AI.is_move_possible(block, next_block, cell):
 
-                cell.move(direction)
+                self.move(cell, direction)
                 return
 
     @staticmethod
@@ -77,9 +83,51 @@ class AI():
                     cells.append(y)
         return cells
 
-    def __init__(self):
-        self.visited = {}
+    def __init__(self, use_distance_fields=False, use_path_cache=False,
+                 budgeted=False, safety_margin=0.05, workers=0, use_astar=False, bidirectional=False,
+                 use_reachability=False, use_threat_map=False, use_assignment=False, seed=None):
+        self.visited = None
         self.cells = {}
+        self.budgeted = budgeted
+        self.safety_margin = safety_margin
+        self.use_distance_fields = use_distance_fields
+        self.distance_fields = DistanceFields()
+        self.path_cache = PathCache() if use_path_cache else None
+        self.planner = ParallelPlanner(workers) if workers else None
+        self.use_astar = use_astar
+        self.bidirectional = bidirectional
+        self.reachability = Reachability() if use_reachability else None
+        self.use_threat_map = use_threat_map
+        self.use_assignment = use_assignment
+        self.threats = None
+        # goal blocks claimed by this AI's cells during the current turn
+        self.targets = set()
+        # ids of the cells that explored this turn and the turn before
+        self.exploring = set()
+        self.explored = set()
+        # a seed makes the searches deterministic, see DirectionOrder
+        self.directions = DirectionOrder(seed) if seed is not None else None
+
+    def close(self):
+        if self.planner is not None:
+            self.planner.close()
+
+    def on_init(self, world):
+        # per-map state, set up once the init message is in rather than in the
+        # first timed turn; visited is one bit per block index
+        self.visited = bytearray((world.map.width * world.map.height + 7) >> 3)
+        if self.planner is not None:
+            self.planner.attach(world)
+        if self.reachability is not None:
+            self.reachability.attach(world)
+        if self.path_cache is not None:
+            self.path_cache.attach(world)
+
+    def is_visited(self, index):
+        return self.visited[index >> 3] >> (index & 7) & 1
+
+    def mark_visited(self, index):
+        self.visited[index >> 3] |= 1 << (index & 7)
 
     @staticmethod
     def is_in_bounds(world, pos):
@@ -93,7 +141,7 @@ class AI():
 
         if cells:
             for cell in cells:
-                if cell.id != my_cell.id and cell.pos == end.pos:
+                if cell.id != my_cell.id and cell.index == end.index:
                     return False
 
         next_height = next_height or end.height
@@ -107,68 +155,91 @@ class AI():
 
     @staticmethod
     def get_reverse_direction(direction):
-        return AI.REVERSE_DIRECTIONS[direction]
+        return Constants.REVERSE_DIRECTIONS[direction]
 
     @staticmethod
-    def get_next_to_pos(world, cell, start, end):
-        visited = set([])
-        q = [AI.Node(start, None, None)]
-        visited.add(start)
-
-        while len(q) != 0:
-            cur = q.pop(0)
-            if cur.block == end:
-                if cur.parent:
-                    while cur.parent.parent:
-                        cur = cur.parent
-                    return cur
-                else:
-                    return None
+    def get_next_to_pos(world, cell, start, end, order=None):
+        started = metrics.clock()
+        cur = AI.search_path(world, cell, start, end, order)
+        metrics.add('ai.bfs.next_to_pos', started)
+        if cur and cur.parent:
+            while cur.parent.parent:
+                cur = cur.parent
+            return cur
+        return None
 
-            random.shuffle(AI.DIRECTIONS)
-            for direction in AI.DIRECTIONS:
-                next_pos = world.map.get_next_pos(direction, cur.block.pos)
+    @staticmethod
+    def search_path(world, cell, start, end, order=None):
+        # the is_move_possible rules on the Map columns; Nodes only for queued blocks
+        world_map = world.map
+        world_map.refresh_heights()
+        neighbors = world_map.neighbors
+        types = world_map.types
+        heights = world_map.heights
+        impassable = Block.IMPASSABLE_CODE
+        none = Block.NONE_CODE
+        jump = cell.jump
+        goal = end.index
+        visited = set([start.index])
+        q = deque([AI.Node(start, None, None)])
 
-                if not AI.is_in_bounds(world, next_pos):
+        while len(q) != 0:
+            cur = q.popleft()
+            index = cur.block.index
+            if index == goal:
+                return cur
+
+            if order is None:
+                random.shuffle(AI.DIRECTIONS)
+                directions = AI.DIRECTIONS
+            else:
+                directions = order(index)
+            height = heights[index]
+            for direction in directions:
+                next_index = neighbors[direction][index]
+                if next_index < 0 or next_index in visited:
+                    continue
+                next_type = types[next_index]
+                if next_type == 0 or next_type == impassable or next_type == none \
+                        or heights[next_index] - height > jump:
+                    continue
+                occupant = world.cell_at(next_index)
+                if occupant is not None and occupant.id != cell.id:
                     continue
 
-                i = AI.Node(world.map.at(next_pos), cur, direction)
-
-                if i.block \
-                        and AI.is_move_possible(cur.block, i.block, cell,
-                                                cells=world.all_cells.values()) \
-                        and i.block.type != Constants.BLOCK_TYPE_NONE \
-                        and i.block not in visited:
-
-                    q.append(i)
-                    visited.add(i.block)
+                q.append(AI.Node(world_map.block_at(next_index), cur, direction))
+                visited.add(next_index)
 
         return None
 
     @staticmethod
-    def get_next_to_type(world, cell, start, block_type):
-        visited = set([])
-        q = [AI.Node(start, None, None)]
-        visited.add(start)
+    def get_next_to_type(world, cell, start, block_type, order=None, targets=()):
+        # targets: goal blocks already claimed this turn
+        world_map = world.map
+        world_map.refresh_heights()
+        neighbors = world_map.neighbors
+        types = world_map.types
+        heights = world_map.heights
+        impassable = Block.IMPASSABLE_CODE
+        # NONE blocks are only walked through when they are the goal
+        none = Block.NONE_CODE if block_type != Constants.BLOCK_TYPE_NONE else impassable
+        code = ord(block_type)
+        is_resource = code == Block.RESOURCE_CODE
+        jump = cell.jump
+        visited = set([start.index])
+        q = deque([AI.Node(start, None, None)])
 
         while len(q) != 0:
-            cur = q.pop(0)
+            cur = q.popleft()
 
             end_block = cur.block
-            if cur.block.type == block_type \
-                    and (end_block.pos['x'], end_block.pos['y']) not in AI.targets \
-                    and (block_type != Constants.BLOCK_TYPE_RESOURCE or AI.should_gain_resource(world, cell, cur.block)):
-
-                if block_type == Constants.BLOCK_TYPE_RESOURCE:
-                    is_target_empty = True
+            index = end_block.index
+            if types[index] == code \
+                    and index not in targets \
+                    and (not is_resource or AI.should_gain_resource(world, cell, end_block)):
 
-                    for world_cell in world.all_cells.values():
-                        if world_cell.pos == end_block.pos:
-                            is_target_empty = False
-                            break
-
-                    if not is_target_empty:
-                        continue
+                if is_resource and world.cell_at(index) is not None:
+                    continue
 
                 if cur.parent:
                     while cur.parent.parent:
@@ -177,24 +248,136 @@ class AI():
                 else:
                     return None, None
 
-            random.shuffle(AI.DIRECTIONS)
-            for direction in AI.DIRECTIONS:
-                next_pos = world.map.get_next_pos(direction, cur.block.pos)
-
-                if not AI.is_in_bounds(world, next_pos):
+            if order is None:
+                random.shuffle(AI.DIRECTIONS)
+                directions = AI.DIRECTIONS
+            else:
+                directions = order(index)
+            height = heights[index]
+            for direction in directions:
+                next_index = neighbors[direction][index]
+                if next_index < 0 or next_index in visited:
+                    continue
+                next_type = types[next_index]
+                if next_type == 0 or next_type == impassable or next_type == none \
+                        or heights[next_index] - height > jump:
                     continue
 
-                i = AI.Node(world.map.at(next_pos), cur, direction)
+                q.append(AI.Node(world_map.block_at(next_index), cur, direction))
+                visited.add(next_index)
 
-                if i.block \
-                        and AI.is_move_possible(cur.block, i.block, cell, cells=None) \
-                        and (i.block.type != Constants.BLOCK_TYPE_NONE or block_type == Constants.BLOCK_TYPE_NONE) \
-                        and i.block not in visited:
+        return None, None
 
-                    q.append(i)
-                    visited.add(i.block)
+    def find_next_to_pos(self, world, cell, start, end):
+        if self.path_cache is None and not (self.use_astar or self.bidirectional):
+            return AI.get_next_to_pos(world, cell, start, end, self.directions)
+
+        found = False
+        if self.path_cache is not None:
+            self.path_cache.attach(world)
+            key = (start.index, end.index, cell.jump)
+            found, path = self.path_cache.get(key)
+        if not found:
+            path = self.find_path(world, cell, start, end)
+            if self.path_cache is not None:
+                self.path_cache.put(key, start.index, path)
+
+        if not path:
+            return None
+        direction, next_index = path[0]
+        return AI.Node(world.map.block_at(next_index), AI.Node(start, None, None), direction)
+
+    def can_reach(self, world, cell, start, end):
+        # yes/no version of find_next_to_pos; the components ignore other cells
+        if self.reachability is None:
+            return self.find_next_to_pos(world, cell, start, end)
+        self.reachability.attach(world)
+        started = metrics.clock()
+        reachable = self.reachability.can_reach(start.index, end.index, cell.jump)
+        metrics.add('ai.reachability', started)
+        return reachable
+
+    def find_path(self, world, cell, start, end):
+        if self.bidirectional:
+            started = metrics.clock()
+            path = PathSearch(world, cell).bidirectional(start.index, end.index)
+            metrics.add('ai.bidirectional.next_to_pos', started)
+            return path
+        if self.use_astar:
+            started = metrics.clock()
+            path = PathSearch(world, cell).a_star(start.index, end.index)
+            metrics.add('ai.astar.next_to_pos', started)
+            return path
+
+        started = metrics.clock()
+        cur = AI.search_path(world, cell, start, end, self.directions)
+        metrics.add('ai.bfs.next_to_pos', started)
+        if not cur:
+            return None
+        path = []
+        while cur.parent:
+            path.append((cur.direction, cur.block.index))
+            cur = cur.parent
+        path.reverse()
+        return path
+
+    def find_next_to_type(self, world, cell, start, block_type):
+        if not self.use_distance_fields:
+            started = metrics.clock()
+            result = AI.get_next_to_type(world, cell, start, block_type, self.directions, self.targets)
+            metrics.add('ai.bfs.next_to_type', started)
+            return result
+
+        field = self.get_distance_field(world, cell, block_type)
+        next_step = field.next_step(start.index)
+        if next_step is None:
+            return None, None
+
+        goal = world.map.block_at(field.goal_of(start.index))
+        while goal.index in self.targets:
+            # nearest goal was claimed this turn: take it out of the field and
+            # look again
+            field.remove_source(goal.index)
+            next_step = field.next_step(start.index)
+            if next_step is None:
+                return None, None
+            goal = world.map.block_at(field.goal_of(start.index))
+
+        direction, next_index = next_step
+        return AI.Node(world.map.block_at(next_index), AI.Node(start, None, None), direction), goal
 
-        return None, None
+    @staticmethod
+    def goal_key(cell, block_type):
+        # cells with the same key see the same goals at the same distances
+        if block_type == Constants.BLOCK_TYPE_RESOURCE:
+            return (block_type, cell.jump, cell.gain_rate)
+        return (block_type, cell.jump)
+
+    @staticmethod
+    def goal_sources(world, cell, block_type, targets=()):
+        sources = []
+        for index in world.map.indexes_of(block_type):
+            if index in targets:
+                continue
+            if block_type == Constants.BLOCK_TYPE_RESOURCE \
+                    and (world.cell_at(index) is not None
+                         or not AI.should_gain_resource(world, cell, world.map.block_at(index))):
+                continue
+            sources.append(index)
+        return sources
+
+    def get_distance_field(self, world, cell, block_type):
+        key = AI.goal_key(cell, block_type)
+
+        def build():
+            sources = AI.goal_sources(world, cell, block_type, self.targets)
+            started = metrics.clock()
+            field = DistanceField(world.map, sources, cell.jump,
+                                  allow_none=block_type == Constants.BLOCK_TYPE_NONE)
+            metrics.add('ai.distance_field', started)
+            return field
+
+        return self.distance_fields.get(key, build)
 
     @staticmethod
     def win_probability(world, me, enemy):
@@ -208,175 +391,445 @@ class AI():
         return enemy_turns_to_kill - my_turns_to_kill
 
     @staticmethod
-    def should_do_attack(world, cell):
-        for enemy_cell in world.enemy_cells.values():
-            for direction in AI.DIRECTIONS:
-                if world.map.get_next_pos(direction,
-                                          cell.pos) == enemy_cell.pos:
-                    win_prob = AI.win_probability(world, cell, enemy_cell)
-                    #print("Win Prob:", win_prob)
-                    if win_prob >= -1:
-                        return direction
+    def should_do_attack(world, cell, order=None):
+        neighbors = world.map.neighbors
+        index = cell.index
+        for direction in AI.DIRECTIONS if order is None else order(index):
+            next_index = neighbors[direction][index]
+            if next_index < 0:
+                continue
+            enemy_cell = world.enemy_cell_at(next_index)
+            if enemy_cell is not None:
+                win_prob = AI.win_probability(world, cell, enemy_cell)
+                #print("Win Prob:", win_prob)
+                if win_prob >= AI.ATTACK_WIN_THRESHOLD:
+                    return direction
         return None
 
+    def attack_direction(self, world, cell):
+        if self.threats is None:
+            return AI.should_do_attack(world, cell, self.directions)
+        # the adjacent enemy we are most likely to beat, against the time all
+        # the adjacent enemies together need to kill us
+        best = None
+        best_win = None
+        enemy_turns_to_kill = self.threats.turns_to_kill(cell.index, cell.energy)
+        for direction, enemy_cell in self.threats.attackers_of(cell.index):
+            win_prob = enemy_turns_to_kill - ceil((enemy_cell.energy + 1) / cell.attack_value)
+            if win_prob >= AI.ATTACK_WIN_THRESHOLD and (best_win is None or win_prob > best_win):
+                best = direction
+                best_win = win_prob
+        return best
+
+    def flee_direction(self, world, cell):
+        if self.threats is None:
+            return AI.walk_away(world, cell, self.directions)
+        return self.threats.flee_direction(cell.index)
+
     @staticmethod
     def should_gain_resource(world, cell, block=None):
-        block = block or world.map.at(cell.pos)
-
-        if block.resource == 0:
+        world_map = world.map
+        index = cell.index if block is None else block.index
+        resource = world_map.resources[index]
+        if resource == 0:
             return False
 
         new_height = min(
-            9, block.min_height + max(0, block.resource - cell.gain_rate) / 50)
-
-        for direction in AI.DIRECTIONS:
-            next_pos = world.map.get_next_pos(direction, block.pos)
-            if not AI.is_in_bounds(world, next_pos):
-                continue
-
-            next_block = world.map.at(next_pos)
-
-            if next_block and next_block.type not in [Constants.BLOCK_TYPE_IMPASSABLE, Constants.BLOCK_TYPE_NONE] \
-                    and AI.is_move_possible(world.map.at(block.pos), next_block, cell, current_height=new_height):
+            9, world_map.min_heights[index] + max(0, resource - cell.gain_rate) / 50)
+
+        world_map.refresh_heights()
+        types = world_map.types
+        heights = world_map.heights
+        height = new_height or heights[index]
+        for direction, next_index in world_map.neighbors_of(index):
+            next_type = types[next_index]
+            if next_type and next_type != Block.IMPASSABLE_CODE and next_type != Block.NONE_CODE \
+                    and heights[next_index] - height <= cell.jump:
                 return True
 
         return False
 
     @staticmethod
-    def walk_away(world, cell):
+    def walk_away(world, cell, order=None):
+        neighbors = world.map.neighbors
+        index = cell.index
         visited = set([])
-        for direction in AI.DIRECTIONS:
-            next_pos = world.map.get_next_pos(direction, cell.pos)
-            if (next_pos['x'], next_pos['y']) not in visited:
-                visited.add((next_pos['x'], next_pos['y']))
-                for enemy_cell in world.enemy_cells.values():
-                    if enemy_cell.pos == next_pos:
-                        return AI.get_reverse_direction(direction)
-            for direction_of_direction in AI.DIRECTIONS:
-                next_next = world.map.get_next_pos(
-                    direction_of_direction, next_pos)
-                if (next_next['x'], next_next['y']) not in visited:
-                    visited.add((next_next['x'], next_next['y']))
-                    for enemy_cell in world.enemy_cells.values():
-                        if enemy_cell.pos == next_next:
-                            return AI.get_reverse_direction(direction_of_direction)
+        for direction in AI.DIRECTIONS if order is None else order(index):
+            next_index = neighbors[direction][index]
+            if next_index < 0:
+                continue
+            if next_index not in visited:
+                visited.add(next_index)
+                if world.enemy_cell_at(next_index) is not None:
+                    return AI.get_reverse_direction(direction)
+            for direction_of_direction in AI.DIRECTIONS if order is None else order(next_index):
+                next_next = neighbors[direction_of_direction][next_index]
+                if next_next < 0:
+                    continue
+                if next_next not in visited:
+                    visited.add(next_next)
+                    if world.enemy_cell_at(next_next) is not None:
+                        return AI.get_reverse_direction(direction_of_direction)
 
         return None
 
-    def do_turn(self, world):
+    def do_turn(self, world, should_stop=None):
         #print("Remaining resources: {}".format(
         #    sum([x.resource for x in AI.get_cells_by_type(world, Constants.BLOCK_TYPE_RESOURCE)])))
 
-        if not self.visited:
+        if self.visited is None:
             #print('world.map_size =', world.map_size)
+            self.on_init(world)
+
+        self.targets = set()
+        self.explored = self.exploring
+        self.exploring = set()
+        self.distance_fields.reset(world.turn)
+        if self.directions is not None:
+            self.directions.reset(world.turn)
+        if self.use_threat_map:
+            started = metrics.clock()
+            self.threats = ThreatMap(world, AI.get_average_attack_value(world))
+            metrics.add('ai.threat_map', started)
+
+        started = metrics.clock()
+        if self.planner is not None:
+            self.do_parallel_turn(world, should_stop)
+        elif self.use_assignment:
+            self.do_assigned_turn(world, should_stop)
+        elif self.budgeted:
+            self.do_budgeted_turn(world, should_stop)
+        else:
+            for cell_id, cell in world.my_cells.items():
+                if should_stop is not None and should_stop():
+                    break
+                if not self.plan_urgent(world, cell):
+                    self.plan_goal(world, cell)
+        metrics.add('ai.do_turn', started)
 
-            self.visited = [[False for i in range(world.map_size["height"])]
-                            for j in range(world.map_size["width"])]
+        #print("==========================")
 
-        AI.targets = set()
+    def do_budgeted_turn(self, world, should_stop=None):
+        # attacks, flee and unsticking first, then the expensive searches by
+        # priority; once the deadline is close the rest get a cheap move
+        pending = []
+        for cell_id, cell in list(world.my_cells.items()):
+            if should_stop is not None and should_stop():
+                return
+            if not self.plan_urgent(world, cell, cheap=True):
+                pending.append(cell)
 
-        for cell_id, cell in world.my_cells.items():
-            block = world.map.at(cell.pos)
-            #print(">>> #{}: @{}, ${}, h={}".format(
-            #    cell.id, cell.pos, cell.energy, block.height))
+        pending.sort(key=self.goal_priority)
+        for cell in pending:
+            if should_stop is not None and should_stop():
+                return
+            if self.out_of_time(world):
+                self.fallback_move(world, cell)
+            else:
+                self.plan_goal(world, cell)
+
+    def do_parallel_turn(self, world, should_stop=None):
+        # urgent moves and in-place actions here, the searches in the worker
+        # pool, then the claims in cell order as the sequential turn makes them
+        searches = []
+        for cell_id, cell in list(world.my_cells.items()):
+            if should_stop is not None and should_stop():
+                return
+            if self.plan_urgent(world, cell, cheap=self.budgeted):
+                continue
+            block = world.map.block_at(cell.index)
+            goal_type = AI.goal_type(cell)
+            if goal_type == Constants.BLOCK_TYPE_MITOSIS and self.mitosis_in_place(cell, block):
+                continue
+            if goal_type == Constants.BLOCK_TYPE_RESOURCE and self.gain_in_place(world, cell, block):
+                continue
+            searches.append(cell)
 
-            # UNCOMMENT THIS ******************************************
-            # self.random_walk(world, cell, fully_random=True)
+        timeout = None
+        if self.budgeted:
+            searches.sort(key=self.goal_priority)
+            timeout = max(0, world.model.turn_remaining_time() - self.safety_margin)
+        plans = self.planner.plan(world, [(cell.id, cell.index, cell.jump, cell.gain_rate, AI.goal_type(cell))
+                                          for cell in searches], timeout)
 
-            attack_direction = AI.should_do_attack(world, cell)
-            if attack_direction:
-                #print('== attack({}).'.format(attack_direction))
-                cell.attack(attack_direction)
+        for cell in searches:
+            if should_stop is not None and should_stop():
+                return
+            plan = plans.get(cell.id)
+            if plan is not None:
+                self.follow_plan(world, cell, plan)
+            elif self.budgeted:
+                self.fallback_move(world, cell)
+            else:
+                self.plan_goal(world, cell)
+
+    def do_assigned_turn(self, world, should_stop=None):
+        # urgent moves and in-place actions first, then one target assignment per
+        # group of cells sharing goal type and movement, mitosis groups first
+        groups = {}
+        explorers = []
+        for cell_id, cell in list(world.my_cells.items()):
+            if should_stop is not None and should_stop():
+                return
+            if self.plan_urgent(world, cell, cheap=self.budgeted):
                 continue
-
-            if cell.id not in self.cells:
-                self.cells[cell.id] = {
-                    'last_action': None,
-                    'last_pos': None,
-                    'current_pos': cell.pos,
-                }
+            block = world.map.block_at(cell.index)
+            goal_type = AI.goal_type(cell)
+            if goal_type == Constants.BLOCK_TYPE_MITOSIS and self.mitosis_in_place(cell, block):
+                continue
+            if goal_type == Constants.BLOCK_TYPE_RESOURCE and self.gain_in_place(world, cell, block):
+                continue
+            if goal_type is None:
+                explorers.append(cell)
             else:
-                self.cells[cell.id]['last_pos'] = self.cells[
-                    cell.id]['current_pos']
-                self.cells[cell.id]['current_pos'] = cell.pos
-
-            if self.cells[cell.id]['last_pos'] == \
-                self.cells[cell.id]['current_pos'] \
-                    and self.cells[cell.id]['last_action'] == 'move':
-                self.random_walk(world, cell, fully_random=True)
+                groups.setdefault(AI.goal_key(cell, goal_type), []).append(cell)
+
+        for key in sorted(groups, key=lambda key: (key[0] != Constants.BLOCK_TYPE_MITOSIS,) + key[1:]):
+            cells = groups[key]
+            if self.budgeted and self.out_of_time(world):
+                for cell in cells:
+                    if should_stop is not None and should_stop():
+                        return
+                    self.fallback_move(world, cell)
                 continue
+            started = metrics.clock()
+            assignment = TargetAssignment(world.map, cells[0].jump, AI.goal_sources(world, cells[0], key[0], self.targets))
+            targets = assignment.assign([(cell.id, cell.index) for cell in cells])
+            metrics.add('ai.assignment', started)
+            for cell in cells:
+                if should_stop is not None and should_stop():
+                    return
+                if not self.follow_assignment(world, cell, targets.get(cell.id)):
+                    explorers.append(cell)
 
-            self.visited[cell.pos['x']][cell.pos['y']] = True
+        for cell in explorers:
+            if should_stop is not None and should_stop():
+                return
+            if self.budgeted and self.out_of_time(world):
+                self.fallback_move(world, cell)
+                continue
+            started = metrics.clock()
+            self.explore(world, cell, world.map.block_at(cell.index))
+            metrics.add('ai.explore', started)
 
-            self.cells[cell.id]['last_action'] = 'move'
+    def follow_assignment(self, world, cell, target):
+        if target is None or target[1] is None:
+            return False
+        goal, (direction, next_index) = target
+        block = world.map.block_at(cell.index)
+        if self.can_reach(world, cell, world.map.block_at(goal), block) \
+                and self.can_reach(world, cell, world.map.block_at(next_index), block):
+            self.targets.add(goal)
+            self.move(cell, direction)
+            return True
+        return False
 
-            dir_to_flee = AI.walk_away(world, cell)
-            if dir_to_flee:
-                #print(">>> walking away")
-                cell.move(dir_to_flee)
+    def follow_plan(self, world, cell, plan):
+        candidates, more, explore, explore_more = plan
+        moved = self.claim(cell, candidates, more)
+        if moved is None:
+            # every candidate was claimed by an earlier cell
+            self.plan_goal(world, cell)
+            return
+        if moved:
+            return
+        block = world.map.block_at(cell.index)
+        if explore is None:
+            self.explore(world, cell, block)
+            return
+        self.exploring.add(cell.id)
+        moved = self.claim(cell, explore, explore_more)
+        if moved is None:
+            self.explore(world, cell, block)
+        elif not moved:
+            self.random_walk(world, cell)
+
+    def claim(self, cell, candidates, more):
+        for goal, direction, step, ok in candidates:
+            if goal in self.targets:
                 continue
+            if direction is None or not ok:
+                return False
+            self.targets.add(goal)
+            self.move(cell, direction)
+            return True
+        return None if more else False
 
-            # MITOSIS cell
-            elif cell.energy >= Constants.CELL_MIN_ENERGY_FOR_MITOSIS:
-                if block.type == Constants.BLOCK_TYPE_MITOSIS:
-                    #print("== mitosis()")
-                    cell.mitosis()
-                    self.cells[cell.id]['last_action'] = 'mitosis'
-                    continue
-                else:
-                    go_block, goal = AI.get_next_to_type(
-                        world, cell, block, Constants.BLOCK_TYPE_MITOSIS)
-                    if go_block and \
-                            go_block.direction:
-                        next_to_mitos = AI.get_next_to_pos(
-                            world, cell, goal, world.map.at(cell.pos))
-                        next_to_me = AI.get_next_to_pos(
-                            world, cell, go_block.block, world.map.at(cell.pos))
-
-                        if next_to_me and next_to_mitos:
-                            AI.targets.add((goal.pos['x'], goal.pos['y']))
-                            cell.move(go_block.direction)
-                            continue
-
-            # RESOURCE cell
-            elif cell.energy < Constants.CELL_MAX_ENERGY:
-                if block.type == Constants.BLOCK_TYPE_RESOURCE and \
-                        AI.should_gain_resource(world, cell):
-                    #print(
-                    #    "== gain_resource() --> h={}, ${}".format(block.height, block.resource))
-                    cell.gain_resource()
-                    self.cells[cell.id]['last_action'] = 'gain'
-                    continue
-                else:
-                    # not in a resource block
-                    go_block, goal = AI.get_next_to_type(
-                        world, cell, block, Constants.BLOCK_TYPE_RESOURCE)
-
-                    if go_block \
-                            and go_block.direction:
-                        next_to_res = AI.get_next_to_pos(
-                            world, cell, goal, world.map.at(cell.pos))
-                        next_to_me = AI.get_next_to_pos(
-                            world, cell, go_block.block, world.map.at(cell.pos))
-
-                        if next_to_res and next_to_me:
-                            AI.targets.add((goal.pos['x'], goal.pos['y']))
-                            cell.move(go_block.direction)
-                            continue
-
-            #print("Couldn't find a resource or mitosis block. Exploring...")
-            go_block, goal = AI.get_next_to_type(
-                world, cell, block, Constants.BLOCK_TYPE_NONE)
-
-            if go_block and go_block.direction and \
-                    AI.get_next_to_pos(world, cell,
-                                       go_block.block, world.map.at(cell.pos)):
-
-                AI.targets.add((goal.pos['x'], goal.pos['y']))
-                cell.move(go_block.direction)
-                continue
+    @staticmethod
+    def goal_type(cell):
+        if cell.energy >= Constants.CELL_MIN_ENERGY_FOR_MITOSIS:
+            return Constants.BLOCK_TYPE_MITOSIS
+        elif cell.energy < Constants.CELL_MAX_ENERGY:
+            return Constants.BLOCK_TYPE_RESOURCE
+        return None
 
-            else:
-                self.random_walk(world, cell)
+    def out_of_time(self, world):
+        return world.model.turn_remaining_time() < self.safety_margin
+
+    def goal_priority(self, cell):
+        # mitosis, then resource, then the cells that found no goal and explored
+        # last turn
+        if cell.id in self.explored:
+            return 2
+        return 0 if AI.goal_type(cell) == Constants.BLOCK_TYPE_MITOSIS else 1
+
+    def move(self, cell, direction):
+        if cell.id in self.cells:
+            self.cells[cell.id]['last_direction'] = direction
+        cell.move(direction)
+
+    def fallback_move(self, world, cell):
+        record = self.cells.get(cell.id)
+        direction = record and record.get('last_direction')
+        if direction:
+            block = world.map.block_at(cell.index)
+            next_index = world.map.next_index(direction, block.index)
+            next_block = world.map.block_at(next_index) if next_index >= 0 else None
+            if next_block \
+                    and next_block.type != Constants.BLOCK_TYPE_NONE \
+                    and world.cell_at(next_index) is None \
+                    and AI.is_move_possible(block, next_block, cell):
+                self.move(cell, direction)
+                return
+        self.random_walk(world, cell, fully_random=True, cheap=True)
+
+    def plan_urgent(self, world, cell, cheap=False):
+        #print(">>> #{}: @{}, ${}, h={}".format(
+        #    cell.id, cell.pos, cell.energy, world.map.block_at(cell.index).height))
+
+        # UNCOMMENT THIS ******************************************
+        # self.random_walk(world, cell, fully_random=True)
+
+        started = metrics.clock()
+        attack_direction = self.attack_direction(world, cell)
+        metrics.add('ai.attack', started)
+        if attack_direction:
+            #print('== attack({}).'.format(attack_direction))
+            cell.attack(attack_direction)
+            return True
+
+        if cell.id not in self.cells:
+            self.cells[cell.id] = {
+                'last_action': None,
+                'last_pos': None,
+                'current_pos': cell.index,
+                'last_direction': None,
+            }
+        else:
+            self.cells[cell.id]['last_pos'] = self.cells[
+                cell.id]['current_pos']
+            self.cells[cell.id]['current_pos'] = cell.index
 
-        #print("==========================")
+        if self.cells[cell.id]['last_pos'] == \
+            self.cells[cell.id]['current_pos'] \
+                and self.cells[cell.id]['last_action'] == 'move':
+            self.random_walk(world, cell, fully_random=True, cheap=cheap)
+            return True
+
+        self.mark_visited(cell.index)
+
+        self.cells[cell.id]['last_action'] = 'move'
+
+        started = metrics.clock()
+        dir_to_flee = self.flee_direction(world, cell)
+        metrics.add('ai.flee', started)
+        if dir_to_flee:
+            #print(">>> walking away")
+            self.move(cell, dir_to_flee)
+            return True
+
+        return False
+
+    def plan_goal(self, world, cell):
+        block = world.map.block_at(cell.index)
+
+        started = metrics.clock()
+        # MITOSIS cell
+        if cell.energy >= Constants.CELL_MIN_ENERGY_FOR_MITOSIS:
+            acted = self.try_mitosis(world, cell, block)
+            metrics.add('ai.mitosis', started)
+        # RESOURCE cell
+        elif cell.energy < Constants.CELL_MAX_ENERGY:
+            acted = self.try_resource(world, cell, block)
+            metrics.add('ai.resource', started)
+        else:
+            acted = False
+
+        if not acted:
+            started = metrics.clock()
+            self.explore(world, cell, block)
+            metrics.add('ai.explore', started)
+
+    def mitosis_in_place(self, cell, block):
+        if block.type == Constants.BLOCK_TYPE_MITOSIS:
+            #print("== mitosis()")
+            cell.mitosis()
+            self.cells[cell.id]['last_action'] = 'mitosis'
+            return True
+        return False
+
+    def gain_in_place(self, world, cell, block):
+        if block.type == Constants.BLOCK_TYPE_RESOURCE and \
+                AI.should_gain_resource(world, cell):
+            #print(
+            #    "== gain_resource() --> h={}, ${}".format(block.height, block.resource))
+            cell.gain_resource()
+            self.cells[cell.id]['last_action'] = 'gain'
+            return True
+        return False
+
+    def try_mitosis(self, world, cell, block):
+        if self.mitosis_in_place(cell, block):
+            return True
+
+        go_block, goal = self.find_next_to_type(
+            world, cell, block, Constants.BLOCK_TYPE_MITOSIS)
+        if go_block and \
+                go_block.direction:
+            next_to_mitos = self.can_reach(
+                world, cell, goal, world.map.block_at(cell.index))
+            next_to_me = self.can_reach(
+                world, cell, go_block.block, world.map.block_at(cell.index))
+
+            if next_to_me and next_to_mitos:
+                self.targets.add(goal.index)
+                self.move(cell, go_block.direction)
+                return True
+        return False
+
+    def try_resource(self, world, cell, block):
+        if self.gain_in_place(world, cell, block):
+            return True
+
+        # not in a resource block
+        go_block, goal = self.find_next_to_type(
+            world, cell, block, Constants.BLOCK_TYPE_RESOURCE)
+
+        if go_block \
+                and go_block.direction:
+            next_to_res = self.can_reach(
+                world, cell, goal, world.map.block_at(cell.index))
+            next_to_me = self.can_reach(
+                world, cell, go_block.block, world.map.block_at(cell.index))
+
+            if next_to_res and next_to_me:
+                self.targets.add(goal.index)
+                self.move(cell, go_block.direction)
+                return True
+        return False
+
+    def explore(self, world, cell, block):
+        #print("Couldn't find a resource or mitosis block. Exploring...")
+        self.exploring.add(cell.id)
+        go_block, goal = self.find_next_to_type(
+            world, cell, block, Constants.BLOCK_TYPE_NONE)
+
+        if go_block and go_block.direction and \
+                self.can_reach(world, cell,
+                               go_block.block, world.map.block_at(cell.index)):
+
+            self.targets.add(goal.index)
+            self.move(cell, go_block.direction)
+
+        else:
+            self.random_walk(world, cell)
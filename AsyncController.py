@@ -0,0 +1,146 @@
+import asyncio
+import socket
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from Network import Network, FrameDecoder
+from Model import Constants
+from Controller import BaseController
+from Metrics import metrics
+
+
+class EventSink():
+    # Model.queue replacement: AI threads hand events to the event loop
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+
+    def put(self, event):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+
+class AsyncController(BaseController):
+    def __init__(self, settings_file):
+        super().__init__(settings_file)
+        self.events = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.running = True
+        self.turn_lock = Lock()
+
+    def start(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        self.read_settings()
+        self.events = asyncio.Queue()
+        self.setup(EventSink(asyncio.get_running_loop(), self.events))
+
+        try:
+            reader, writer = await asyncio.open_connection(self.conf[Constants.CONFIG_KEY_IP],
+                                                           self.conf[Constants.CONFIG_KEY_PORT])
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            writer.write(Network.encode_frames([{Constants.KEY_NAME: Constants.CONFIG_KEY_TOKEN,
+                                                 Constants.KEY_ARGS: [self.conf[Constants.CONFIG_KEY_TOKEN]]}]))
+            protocol = FrameReader(reader, self.recorder)
+            init = await protocol.receive()
+            if init[Constants.KEY_NAME] == "wrong token":
+                raise ConnectionRefusedError("wrong token")
+            elif not init[Constants.KEY_NAME] == Constants.MESSAGE_TYPE_INIT:
+                writer.close()
+                raise IOError("first message was not init")
+        except Exception as e:
+            print("error while connecting to server", e)
+            return
+        print("connected to server!")
+        self.handle_message(init)
+
+        sender = asyncio.create_task(self.send_events(writer))
+        try:
+            while self.running:
+                self.handle_message(await protocol.receive())
+        except ConnectionError:
+            print("disconnected from server!")
+        finally:
+            sender.cancel()
+            writer.close()
+            self.stop_planning.set()
+            self.executor.shutdown(wait=False)
+            self.client.close()
+            if self.recorder is not None:
+                self.recorder.close()
+            metrics.dump()
+
+    async def send_events(self, writer):
+        while True:
+            pending = [await self.events.get()]
+            while not self.events.empty():
+                pending.append(self.events.get_nowait())
+            events = []
+            queued = []
+            for turn, queued_at, event in pending:
+                # actions of a turn the server has already closed
+                if turn != self.current_turn:
+                    self.dropped_events += 1
+                    continue
+                events.append(event)
+                queued.append(queued_at)
+            if not events:
+                continue
+            data = Network.encode_frames([{
+                Constants.KEY_NAME: Constants.MESSAGE_TYPE_EVENT,
+                Constants.KEY_ARGS: [event]
+            } for event in events])
+            if self.recorder is not None:
+                self.recorder.record_sent(data)
+            started = metrics.clock()
+            writer.write(data)
+            await writer.drain()
+            metrics.add('controller.send', started)
+            for queued_at in queued:
+                metrics.add('controller.event_latency', queued_at)
+
+    def do_turn(self, message):
+        # same turn handling as Controller: the world is only touched by the
+        # single planner thread, and planning for an older turn is stopped
+        with self.turn_lock:
+            self.turn_messages.append((time.time(), message))
+            self.current_turn = message[Constants.KEY_ARGS][0]
+            self.stop_planning.set()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.plan)
+        future.add_done_callback(self.planned)
+
+    def planned(self, future):
+        # the future is never awaited, so report planner errors here
+        if not future.cancelled() and future.exception() is not None:
+            traceback.print_exception(future.exception())
+
+    def plan(self):
+        with self.turn_lock:
+            messages = list(self.turn_messages)
+            self.turn_messages.clear()
+            self.stop_planning.clear()
+        # an earlier job already took these turns
+        if not messages:
+            return
+        self.plan_messages(messages)
+
+    def terminate(self):
+        self.print_summary()
+        self.running = False
+
+
+class FrameReader():
+    def __init__(self, reader, recorder=None):
+        self.reader = reader
+        self.decoder = FrameDecoder(recorder)
+        self.frames = deque()
+
+    async def receive(self):
+        while not self.frames:
+            data = await self.reader.read(Network.RECV_SIZE)
+            if not data:
+                raise ConnectionResetError("connection closed by server")
+            self.decoder.feed(data, self.frames)
+        return self.frames.popleft()
@@ -0,0 +1,228 @@
+import argparse
+import json
+import random
+import sys
+import time
+from Model import Model, Map, Constants
+from AI import AI
+from Planner import PathSearch, DirectionOrder, Reachability
+from Server import Game
+from Replay import EventList
+
+
+def make_world(size, cells, enemy_cells, impassable, seed):
+    # a client world that already sees the whole map and every cell
+    game = Game(size, size, cells_per_team=0, seed=seed, impassable=impassable)
+    for i in range(cells):
+        game.spawn(Game.TEAM_IDS[0], game.random_free_index())
+    for i in range(enemy_cells):
+        game.spawn(Game.TEAM_IDS[1], game.random_free_index())
+
+    model = Model(EventList())
+    model.handle_init_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_INIT,
+                               Constants.KEY_ARGS: [game.team_info(Game.TEAM_IDS[0]), game.map_data]})
+    dynamics = [cell.to_data(game.map) for cell in game.cells.values()]
+    model.handle_turn_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_TURN,
+                               Constants.KEY_ARGS: [1, {Constants.KEY_STATICS: [],
+                                                        Constants.KEY_DYNAMICS: dynamics}]})
+    return game, model
+
+
+class Case():
+    def __init__(self, name, setup, run, calls=1):
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.calls = calls
+
+
+def build_cases(game, model, seed, seeded=False, fresh=None):
+    # fresh() builds another world like this one, for the cases that change it
+    world = model.world
+    rnd = random.Random(seed)
+    my_cells = list(world.my_cells.values())
+    walkable = [block for block in world.map.all_blocks.values()
+                if block.type != Constants.BLOCK_TYPE_IMPASSABLE]
+    pairs = [(rnd.choice(my_cells), rnd.choice(walkable)) for i in range(20)] if my_cells else []
+    statics = [game.block_data(block.index) for block in rnd.sample(walkable, min(200, len(walkable)))]
+    for data in statics:
+        data[Constants.BLOCK_KEY_MIN_HEIGHT] = rnd.randint(0, 3)
+    size_info = {Constants.MAP_SIZE_WIDTH: game.width, Constants.MAP_SIZE_HEIGHT: game.height}
+    order = DirectionOrder(seed) if seeded else None
+
+    def move_dynamics():
+        dynamics = []
+        for cell in world.all_cells.values():
+            block = world.map.block_at(cell.index)
+            direction, next_index = rnd.choice(world.map.neighbors_of(block.index))
+            if world.cell_at(next_index) is None:
+                dynamics.append({Constants.GAME_OBJECT_KEY_ID: cell.id,
+                                 Constants.GAME_OBJECT_KEY_POSITION: world.map.block_at(next_index).pos})
+        return dynamics
+
+    def apply_dynamics(dynamics):
+        for data in dynamics:
+            if world.cell_at(world.map.index_of(data[Constants.GAME_OBJECT_KEY_POSITION])) is None:
+                world.set_dynamic_change(data)
+
+    def next_to_pos():
+        for cell, goal in pairs:
+            AI.get_next_to_pos(world, cell, goal, world.map.block_at(cell.index), order)
+
+    def a_star():
+        # the same queries as next_to_pos: from the goal back to the cell
+        for cell, goal in pairs:
+            PathSearch(world, cell).a_star(goal.index, cell.index)
+
+    def next_to_type():
+        for cell in my_cells:
+            AI.get_next_to_type(world, cell, world.map.block_at(cell.index), Constants.BLOCK_TYPE_RESOURCE, order)
+
+    def set_change():
+        for data in statics:
+            world.map.set_change(data)
+        world.map.refresh_heights()
+
+    reachability = Reachability()
+    resources = list(world.map.indexes_of(Constants.BLOCK_TYPE_RESOURCE))
+
+    def mine():
+        # a turn of mining against components that are already built for every
+        # jump level: some resource blocks lose part of what they have left
+        if reachability.world is None:
+            reachability.attach(world)
+            for jump in range(Constants.CELL_MAX_JUMP + 1):
+                reachability.level(jump)
+        mined = []
+        for index in rnd.sample(resources, min(20, len(resources))):
+            data = game.block_data(index)
+            data[Constants.BLOCK_KEY_RESOURCE] = max(0, world.map.resources[index] - rnd.randint(5, 30))
+            mined.append(data)
+        return mined
+
+    def repair(mined):
+        world.apply_turn(world.turn + 1, mined, [])
+
+    def fresh_turn():
+        # a new world and AI for every run, so no cell looks stuck from the last
+        # one and the turn plans goals instead of walking randomly
+        fresh_game, fresh_model = fresh()
+        ai = AI(seed=seed if seeded else None)
+        ai.on_init(fresh_model.world)
+        return ai, fresh_model.world
+
+    return [
+        Case("Map.__init__", None, lambda state: Map(size_info, game.map_data)),
+        Case("Map.set_change", None, lambda state: set_change(), len(statics)),
+        Case("Reachability.on_turn", mine, repair, Constants.CELL_MAX_JUMP + 1),
+        Case("World.set_dynamic_change", move_dynamics, apply_dynamics, len(world.all_cells)),
+        Case("AI.get_next_to_pos", None, lambda state: next_to_pos(), len(pairs)),
+        Case("PathSearch.a_star", None, lambda state: a_star(), len(pairs)),
+        Case("AI.get_next_to_type", None, lambda state: next_to_type(), len(my_cells)),
+        Case("AI.should_gain_resource", None,
+             lambda state: [AI.should_gain_resource(world, cell, block)
+                            for cell, block in pairs], len(pairs)),
+        Case("AI.walk_away", None, lambda state: [AI.walk_away(world, cell, order) for cell in my_cells], len(my_cells)),
+        Case("AI.should_do_attack", None,
+             lambda state: [AI.should_do_attack(world, cell, order) for cell in my_cells], len(my_cells)),
+        Case("AI.do_turn", fresh_turn, lambda state: state[0].do_turn(state[1])),
+    ]
+
+
+def run_case(case, repeat):
+    samples = []
+    for i in range(repeat):
+        state = case.setup() if case.setup else None
+        started = time.perf_counter()
+        case.run(state)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        'best': samples[0],
+        'median': samples[len(samples) // 2],
+        'per_call': samples[len(samples) // 2] / max(1, case.calls),
+        'calls': case.calls,
+    }
+
+
+def run(sizes, cell_counts, densities, repeat=5, seed=0, only=None, seeded=False):
+    results = []
+    for size in sizes:
+        for cells in cell_counts:
+            for density in densities:
+                def fresh():
+                    return make_world(size, cells, cells // 2, density, seed)
+
+                game, model = fresh()
+                random.seed(seed)
+                for case in build_cases(game, model, seed, seeded, fresh):
+                    if only and case.name not in only:
+                        continue
+                    random.seed(seed)
+                    result = run_case(case, repeat)
+                    result.update({'name': case.name, 'size': size, 'cells': cells, 'density': density})
+                    results.append(result)
+                    print(json.dumps(result), file=sys.stderr)
+    return results
+
+
+def compare(baseline_path, current_path, threshold):
+    def key(result):
+        return (result['name'], result['size'], result['cells'], result['density'])
+
+    with open(baseline_path) as file:
+        baseline = {key(result): result for result in json.load(file)['results']}
+    with open(current_path) as file:
+        current = json.load(file)['results']
+    regressions = 0
+    for result in current:
+        old = baseline.get(key(result))
+        if old is None or not old['median']:
+            continue
+        ratio = result['median'] / old['median']
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        print("{:28} size={:<4} cells={:<4} density={:<5} {:7.3f}x {}".format(
+            result['name'], result['size'], result['cells'], result['density'], ratio, flag))
+    return regressions
+
+
+def parse_list(text, kind):
+    return [kind(value) for value in text.split(",") if value]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="AI planning and Model update microbenchmarks")
+    parser.add_argument("--sizes", default="20,50,100,200")
+    parser.add_argument("--cells", default="10,50,150")
+    parser.add_argument("--density", default="0.08,0.25", help="impassable block ratios")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", help="comma separated benchmark names")
+    parser.add_argument("--seeded", action="store_true",
+                        help="seeded AI searches instead of the shared random.shuffle")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    results = run(parse_list(args.sizes, int), parse_list(args.cells, int), parse_list(args.density, float),
+                  repeat=args.repeat, seed=args.seed, only=args.only and args.only.split(","), seeded=args.seeded)
+    report = {'seed': args.seed, 'seeded': args.seeded, 'repeat': args.repeat, 'python': sys.version.split()[0],
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    else:
+        print(json.dumps(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,64 +1,199 @@
 from Network import Network
 from Model import Model, Constants
 from AI import AI
+from Replay import Recorder
+from Metrics import metrics
 import json
-from threading import Thread
-from queue import Queue
+import sys
+import time
+from collections import deque
+from threading import Thread, Condition, Event
+from queue import Queue, Empty
 
 
-class Controller():
+class TurnQueue():
+    # tags every event with the turn it was planned for and when it was queued
+    def __init__(self, queue):
+        self.queue = queue
+        self.turn = None
+
+    def put(self, event):
+        self.queue.put((self.turn, metrics.clock(), event))
+
+
+class BaseController():
+    # settings, turn planning and the end of match summary of Controller and
+    # AsyncController; subclasses queue (received at, message) pairs in
+    # turn_messages and hand them to plan_messages on one planner thread
     def __init__(self, settings_file):
         self.settings_file = settings_file
-        self.sending_flag = True
         self.conf = {}
+        self.model = None
+        self.client = AI()
+        self.recorder = None
+        self.turn_messages = deque()
+        self.stop_planning = Event()
+        self.current_turn = None
+        self.turn_metrics = []
+        self.dropped_events = 0
+
+    def read_settings(self):
+        with open(self.settings_file) as file:
+            self.conf = json.loads(file.read())
+
+    def setup(self, queue):
+        # metrics, the AI, the model putting its events on queue and the recorder
+        if self.conf.get(Constants.CONFIG_KEY_METRICS):
+            metrics.configure(output=self.conf[Constants.CONFIG_KEY_METRICS],
+                              profile_every=self.conf.get(Constants.CONFIG_KEY_PROFILE_EVERY, 0),
+                              profile_output=self.conf.get(Constants.CONFIG_KEY_PROFILE_OUTPUT))
+        if self.conf.get(Constants.CONFIG_KEY_WORKERS) or self.conf.get(Constants.CONFIG_KEY_SEED) is not None:
+            self.client = AI(workers=self.conf.get(Constants.CONFIG_KEY_WORKERS, 0),
+                             seed=self.conf.get(Constants.CONFIG_KEY_SEED))
+        self.model = Model(TurnQueue(queue),
+                           fog_horizon=self.conf.get(Constants.CONFIG_KEY_FOG_HORIZON),
+                           fog_max_cells=self.conf.get(Constants.CONFIG_KEY_FOG_MAX_CELLS))
+        if self.conf.get(Constants.CONFIG_KEY_RECORD):
+            self.recorder = Recorder(self.conf[Constants.CONFIG_KEY_RECORD])
+
+    def handle_message(self, message):
+        if message[Constants.KEY_NAME] == Constants.MESSAGE_TYPE_INIT:
+            self.model.handle_init_message(message)
+            self.client.on_init(self.model.world)
+        elif message[Constants.KEY_NAME] == Constants.MESSAGE_TYPE_TURN:
+            self.do_turn(message)
+        elif message[Constants.KEY_NAME] == Constants.MESSAGE_TYPE_SHUTDOWN:
+            self.terminate()
+
+    def plan_messages(self, messages):
+        # the world is only mutated here, never while the AI is planning
+        for received_at, message in messages:
+            self.model.handle_turn_message(message)
+        self.model.turn_start_time = received_at
+        turn = self.model.world.turn
+        self.model.queue.turn = turn
+
+        started = time.time()
+        metrics.start_turn(turn)
+        self.client.do_turn(self.model.world, should_stop=self.stop_planning.is_set)
+        metrics.end_turn()
+        finished = time.time()
+        cancelled = self.stop_planning.is_set()
+        self.turn_metrics.append({
+            'turn': turn,
+            'wait': started - received_at,
+            'duration': finished - started,
+            'skipped': len(messages) - 1,
+            'cancelled': cancelled,
+            'overrun': cancelled or finished - received_at > self.model.turn_timeout,
+        })
+
+    def print_summary(self):
+        print("finished!")
+        overruns = len([metric for metric in self.turn_metrics if metric['overrun']])
+        print("turns planned: {}, overruns: {}, dropped events: {}".format(
+            len(self.turn_metrics), overruns, self.dropped_events))
+
+
+class Controller(BaseController):
+    def __init__(self, settings_file):
+        super().__init__(settings_file)
+        self.sending_flag = True
+        self.flush_interval = 0
+        self.max_batch = 0
         self.network = None
         self.queue = Queue()
-        self.model = Model(self.queue)
-        self.client = AI()
+        self.model = Model(TurnQueue(self.queue))
+        self.turn_ready = Condition()
 
     def start(self):
         self.read_settings()
+        self.setup(self.queue)
+        self.flush_interval = self.conf.get(Constants.CONFIG_KEY_FLUSH_INTERVAL, 0)
+        self.max_batch = self.conf.get(Constants.CONFIG_KEY_MAX_BATCH, 0)
         self.network = Network(ip=self.conf[Constants.CONFIG_KEY_IP],
                                port=self.conf[Constants.CONFIG_KEY_PORT],
                                token=self.conf[Constants.CONFIG_KEY_TOKEN],
-                               message_handler=self.handle_message)
+                               message_handler=self.handle_message,
+                               recorder=self.recorder)
+        Thread(target=self.plan_turns, daemon=True).start()
         self.network.connect()
 
         def run():
             while self.sending_flag:
-                event = self.queue.get()
-                self.queue.task_done()
-                message = {
+                events = []
+                queued = []
+                for turn, queued_at, event in self.take_events():
+                    # actions of a turn the server has already closed
+                    if turn != self.current_turn:
+                        self.dropped_events += 1
+                        continue
+                    events.append(event)
+                    queued.append(queued_at)
+                if not events:
+                    continue
+                messages = [{
                     Constants.KEY_NAME: Constants.MESSAGE_TYPE_EVENT,
                     Constants.KEY_ARGS: [event]
-                }
-                self.network.send(message)
+                } for event in events]
+                started = metrics.clock()
+                self.network.send_many(messages)
+                metrics.add('controller.send', started)
+                for queued_at in queued:
+                    metrics.add('controller.event_latency', queued_at)
         Thread(target=run, daemon=True).start()
 
+    def take_events(self):
+        # block for one event, optionally linger flush_interval seconds for
+        # more, then drain whatever is pending (up to max_batch events)
+        events = [self.queue.get()]
+        self.queue.task_done()
+        deadline = time.time() + self.flush_interval
+        while not self.max_batch or len(events) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    event = self.queue.get(timeout=remaining)
+                else:
+                    event = self.queue.get_nowait()
+            except Empty:
+                break
+            self.queue.task_done()
+            events.append(event)
+        return events
+
     def terminate(self):
-        print("finished!")
+        self.print_summary()
         self.network.close()
         self.sending_flag = False
+        self.stop_planning.set()
+        self.client.close()
+        metrics.dump()
 
-    def read_settings(self):
-        with open(self.settings_file) as file:
-            self.conf = json.loads(file.read())
+    def do_turn(self, message):
+        # hand the turn to the planner worker and stop any planning still
+        # running for an older turn
+        with self.turn_ready:
+            self.turn_messages.append((time.time(), message))
+            self.current_turn = message[Constants.KEY_ARGS][0]
+            self.stop_planning.set()
+            self.turn_ready.notify()
 
-    def handle_message(self, message):
-        if message[Constants.KEY_NAME] == Constants.MESSAGE_TYPE_INIT:
-            self.model.handle_init_message(message)
-        elif message[Constants.KEY_NAME] == Constants.MESSAGE_TYPE_TURN:
-            self.model.handle_turn_message(message)
-            self.do_turn()
-        elif message[Constants.KEY_NAME] == Constants.MESSAGE_TYPE_SHUTDOWN:
-            self.terminate()
-
-    def do_turn(self):
+    def plan_turns(self):
+        while self.sending_flag:
+            with self.turn_ready:
+                while not self.turn_messages:
+                    self.turn_ready.wait()
+                messages = list(self.turn_messages)
+                self.turn_messages.clear()
+                self.stop_planning.clear()
+            self.plan_messages(messages)
 
-        def run():
-            self.client.do_turn(self.model.world)
-
-        Thread(target=run, daemon=True).start()
 
-c = Controller("connection.conf")
-c.start()
\ No newline at end of file
+if __name__ == "__main__":
+    if "--asyncio" in sys.argv[1:]:
+        from AsyncController import AsyncController
+        c = AsyncController("connection.conf")
+    else:
+        c = Controller("connection.conf")
+    c.start()
@@ -0,0 +1,117 @@
+import cProfile
+import json
+import pstats
+import sys
+import time
+from collections import deque
+from threading import Lock
+
+
+class Histogram():
+    # keeps totals for the whole match and a rolling window for percentiles;
+    # a window of None keeps every sample
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class Metrics():
+    def __init__(self):
+        self.enabled = False
+        self.output = None
+        self.window = 1000
+        self.histograms = {}
+        self.lock = Lock()
+        self.profile_every = 0
+        self.profile_output = None
+        self.profiler = None
+        self.profile_stats = None
+        self.turn = None
+
+    def configure(self, output="stderr", window=1000, profile_every=0, profile_output=None):
+        self.enabled = True
+        self.output = output
+        self.window = window
+        self.profile_every = profile_every
+        self.profile_output = profile_output
+
+    def clock(self):
+        # pass the result to add(); None keeps disabled instrumentation cheap
+        if not self.enabled:
+            return None
+        return time.perf_counter()
+
+    def add(self, name, started):
+        if started is None:
+            return
+        self.add_value(name, time.perf_counter() - started)
+
+    def add_value(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.window)
+            histogram.add(value)
+
+    def start_turn(self, turn):
+        self.turn = turn
+        if self.enabled and self.profile_every and turn % self.profile_every == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def end_turn(self):
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        if self.profile_stats is None:
+            self.profile_stats = pstats.Stats(self.profiler, stream=sys.stderr)
+        else:
+            self.profile_stats.add(self.profiler)
+        self.profiler = None
+
+    def report(self):
+        with self.lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+    def dump(self):
+        if not self.enabled:
+            return
+        report = json.dumps({'turn': self.turn, 'timings': self.report()}, indent=1)
+        if self.output in (None, "stderr"):
+            print(report, file=sys.stderr)
+        else:
+            with open(self.output, 'w') as file:
+                file.write(report)
+        if self.profile_stats is not None:
+            if self.profile_output:
+                self.profile_stats.dump_stats(self.profile_output)
+            else:
+                self.profile_stats.sort_stats('cumulative').print_stats(30)
+
+
+metrics = Metrics()
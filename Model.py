@@ -1,27 +1,33 @@
 import time
+from array import array
+from collections import OrderedDict
+from Metrics import metrics
 
 
 class Model():
-    def __init__(self, queue):
+    def __init__(self, queue, fog_horizon=None, fog_max_cells=None):
         self.turn_timeout = 0.4
         self.turn_start_time = 0
         self.world = None
         self.queue = queue
+        self.fog_horizon = fog_horizon
+        self.fog_max_cells = fog_max_cells
 
     def handle_init_message(self, message):
         init_info = message[Constants.KEY_ARGS][0]
         map_data = message[Constants.KEY_ARGS][1]
+        # Map.load works out the block heights, so the coefficient comes first
+        Block.block_coefficient = init_info[Constants.INFO_KEY_BLOCK_COEFFICIENT]
         map1 = Map(init_info[Constants.INFO_KEY_MAP_SIZE], map_data)
-        self.world = World(self, init_info, map1)
+        self.world = World(self, init_info, map1, self.fog_horizon, self.fog_max_cells)
 
     def handle_turn_message(self, message):
         self.turn_start_time = time.time()
-        self.world.turn = message[Constants.KEY_ARGS][0]
+        started = metrics.clock()
         turn_data = message[Constants.KEY_ARGS][1]
-        for static_data in turn_data[Constants.KEY_STATICS]:
-            self.world.set_static_change(static_data)
-        for dynamic_data in turn_data[Constants.KEY_DYNAMICS]:
-            self.world.set_dynamic_change(dynamic_data)
+        self.world.apply_turn(message[Constants.KEY_ARGS][0],
+                              turn_data[Constants.KEY_STATICS], turn_data[Constants.KEY_DYNAMICS])
+        metrics.add('model.turn_message', started)
 
     def turn_remaining_time(self):
         passed = time.time() - self.turn_start_time
@@ -29,20 +35,104 @@ class Model():
 
 
 class World():
-    def __init__(self, model, init_info, map1):
+    # hidden enemy cells are forgotten after this many turns, or oldest first
+    # once more than FOG_MAX_CELLS are remembered; defaults for the arguments
+    FOG_HORIZON = 100
+    FOG_MAX_CELLS = 1000
+
+    def __init__(self, model, init_info, map1, fog_horizon=None, fog_max_cells=None):
         self.model = model
         self.teams = init_info[Constants.INFO_KEY_TEAMS]
         self.my_name = init_info[Constants.INFO_KEY_YOUR_INFO][Constants.KEY_NAME]
         self.my_id = init_info[Constants.INFO_KEY_YOUR_INFO][Constants.KEY_ID]
+        # with a single opponent every cell that is not ours is theirs
+        others = [team[Constants.KEY_ID] for team in self.teams if team[Constants.KEY_ID] != self.my_id]
+        self.enemy_id = others[0] if len(others) == 1 else None
         self.map_size = init_info[Constants.INFO_KEY_MAP_SIZE]
-        Block.block_coefficient = init_info[Constants.INFO_KEY_BLOCK_COEFFICIENT]
         self.map = map1
+        self.map.take_changes()
         self.turn = init_info[Constants.KEY_TURN]
         self.all_cells = {}
         self.my_cells = {}
         self.enemy_cells = {}
         self.all_visited_cells = {}
         self.invisible_cells = {}
+        self.last_seen = LastSeen(self.map, World.FOG_HORIZON if fog_horizon is None else fog_horizon,
+                                  World.FOG_MAX_CELLS if fog_max_cells is None else fog_max_cells)
+        # block index -> cell, only for cells in all_cells
+        self.all_cells_by_pos = {}
+        self.my_cells_by_pos = {}
+        self.enemy_cells_by_pos = {}
+        self.occupancy_listeners = []
+        # changes of the turn being applied, handed to subscribers once it is complete
+        self.delta = Delta(self.turn)
+        self.subscribers = []
+
+    def subscribe(self, subscriber):
+        # subscriber(delta) is called after each turn message has been applied
+        self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def apply_turn(self, turn, statics, dynamics):
+        self.turn = turn
+        self.delta = Delta(turn)
+        self.map.apply_changes(statics)
+        self.map.refresh_heights()
+        for dynamic_data in dynamics:
+            self.set_dynamic_change(dynamic_data)
+        for cell_id in self.last_seen.expire(turn):
+            self.forget_cell(cell_id)
+        self.delta.blocks = self.map.take_changes()
+        for subscriber in self.subscribers:
+            subscriber(self.delta)
+
+    def add_occupancy_listener(self, listener):
+        # listener(index, occupied) is called when a block gains or loses its cell
+        self.occupancy_listeners.append(listener)
+
+    def remove_occupancy_listener(self, listener):
+        if listener in self.occupancy_listeners:
+            self.occupancy_listeners.remove(listener)
+
+    def cell_at(self, index):
+        return self.all_cells_by_pos.get(index)
+
+    def my_cell_at(self, index):
+        return self.my_cells_by_pos.get(index)
+
+    def enemy_cell_at(self, index):
+        return self.enemy_cells_by_pos.get(index)
+
+    def index_cell(self, cell):
+        index = cell.index
+        self.all_cells_by_pos[index] = cell
+        if cell.team_id == self.my_id:
+            self.my_cells_by_pos[index] = cell
+        else:
+            self.enemy_cells_by_pos[index] = cell
+        for listener in self.occupancy_listeners:
+            listener(index, True)
+
+    def unindex_cell(self, cell, index=None):
+        if index is None:
+            index = cell.index
+        if self.all_cells_by_pos.get(index) is cell:
+            self.all_cells_by_pos.pop(index)
+            for listener in self.occupancy_listeners:
+                listener(index, False)
+        if self.my_cells_by_pos.get(index) is cell:
+            self.my_cells_by_pos.pop(index)
+        if self.enemy_cells_by_pos.get(index) is cell:
+            self.enemy_cells_by_pos.pop(index)
+
+    def move_cell(self, cell, old_index):
+        self.delta.moved.setdefault(cell.id, old_index)
+        if cell.id in self.all_cells:
+            self.unindex_cell(cell, old_index)
+            self.index_cell(cell)
 
     def add_cell(self, cell):
         self.all_cells[cell.id] = cell
@@ -51,15 +141,21 @@ class World():
             self.my_cells[cell.id] = cell
         else:
             self.enemy_cells[cell.id] = cell
+        self.index_cell(cell)
+        self.delta.appeared.add(cell.id)
 
     def visible_cell(self, cell):
         if cell.id not in self.all_cells:
             self.add_cell(cell)
-        self.invisible_cells.pop(cell.id)
+        self.invisible_cells.pop(cell.id, None)
+        self.last_seen.remove(cell.id)
 
     def invisible_cell(self, cell):
         self.invisible_cells[cell.id] = cell
+        self.last_seen.record(cell, self.turn)
+        self.delta.hidden.add(cell.id)
         if cell.id in self.all_cells:
+            self.unindex_cell(cell)
             self.all_cells.pop(cell.id)
         if cell.id in self.my_cells:
             self.my_cells.pop(cell.id)
@@ -67,9 +163,11 @@ class World():
             self.enemy_cells.pop(cell.id)
 
     def kill_cell(self, cell):
+        self.delta.died.add(cell.id)
         if cell.id in self.all_visited_cells:
             self.all_visited_cells.pop(cell.id)
         if cell.id in self.all_cells:
+            self.unindex_cell(cell)
             self.all_cells.pop(cell.id)
         if cell.id in self.my_cells:
             self.my_cells.pop(cell.id)
@@ -77,6 +175,13 @@ class World():
             self.enemy_cells.pop(cell.id)
         if cell.id in self.invisible_cells:
             self.invisible_cells.pop(cell.id)
+        self.last_seen.remove(cell.id)
+
+    def forget_cell(self, cell_id):
+        # a hidden cell aged out of last_seen; a later sighting recreates it
+        self.invisible_cells.pop(cell_id, None)
+        self.all_visited_cells.pop(cell_id, None)
+        self.delta.forgotten.add(cell_id)
 
     def set_static_change(self, static_data):
         self.map.set_change(static_data)
@@ -85,7 +190,15 @@ class World():
         cell_id = dynamic_data[Constants.GAME_OBJECT_KEY_ID]
         cell = self.all_visited_cells.get(cell_id)
         if cell is None:
+            if dynamic_data.get(Constants.GAME_OBJECT_KEY_TYPE) == Constants.GAME_OBJECT_TYPE_DESTROYED:
+                return
             cell = Cell(self.model, dynamic_data)
+            if cell.index is None:
+                # an update for a forgotten cell that does not say where it is
+                return
+            if cell.team_id is None:
+                # a forgotten cell seen again through a partial update
+                cell.team_id = self.enemy_id
             self.add_cell(cell)
         else:
             if dynamic_data.get(Constants.GAME_OBJECT_KEY_TYPE) == Constants.GAME_OBJECT_TYPE_DESTROYED:
@@ -96,8 +209,9 @@ class World():
                     if vis == 0:
                         self.invisible_cell(cell)
                     else:
-                        self.visible_cell(cell)
+                        # move first so the occupancy index sees the fresh position
                         cell.set_change(dynamic_data)
+                        self.visible_cell(cell)
                 else:
                     cell.set_change(dynamic_data)
             else:
@@ -105,11 +219,16 @@ class World():
 
 
 class Cell():
+    __slots__ = ('model', 'id', 'team_id', 'index', 'energy', 'depth_of_field', 'jump', 'gain_rate',
+                 'attack_value')
+
     def __init__(self, model, data):
         self.model = model
         self.id = data[Constants.GAME_OBJECT_KEY_ID]
-        self.team_id = data[Constants.GAME_OBJECT_KEY_TEAM_ID]
-        self.pos = None
+        # missing when a forgotten cell is seen again through a partial update
+        self.team_id = data.get(Constants.GAME_OBJECT_KEY_TEAM_ID)
+        # block index; the wire position dict is only built on demand by pos
+        self.index = None
         self.energy = 0
         self.depth_of_field = 0
         self.jump = 0
@@ -120,7 +239,11 @@ class Cell():
     def set_change(self, data):
         pos = data.get(Constants.GAME_OBJECT_KEY_POSITION)
         if pos is not None:
-            self.pos = pos
+            world = self.model.world
+            old_index = self.index
+            self.index = world.map.index_of(pos)
+            if old_index is not None and old_index != self.index:
+                world.move_cell(self, old_index)
         energy = data.get(Constants.CELL_KEY_ENERGY)
         if energy is not None:
             self.energy = energy
@@ -137,6 +260,10 @@ class Cell():
         if attack_value is not None:
             self.attack_value = attack_value
 
+    @property
+    def pos(self):
+        return self.model.world.map.pos_of(self.index)
+
     def move(self, direction):
         event = Event(Event.TYPE_MOVE, self.id, self.team_id)
         event.add_arg(direction)
@@ -157,26 +284,274 @@ class Cell():
 
 
 class Map():
+    INT_ZEROS = array('l', [0])
+    FLOAT_ZEROS = array('d', [0.0])
+    NO_NEIGHBOR = -1
+
     def __init__(self, map_size, map_data):
-        self.blocks = [[None for i in range(map_size[Constants.MAP_SIZE_WIDTH])] for j in
-                       range(map_size[Constants.MAP_SIZE_HEIGHT])]
-        self.all_blocks = {}
+        self.width = map_size[Constants.MAP_SIZE_WIDTH]
+        self.height = map_size[Constants.MAP_SIZE_HEIGHT]
+        size = self.width * self.height
+
+        # struct-of-arrays terrain, indexed by y * width + x
+        self.types = bytearray(size)
+        self.min_heights = Map.INT_ZEROS * size
+        self.resources = Map.INT_ZEROS * size
+        self.heights = Map.FLOAT_ZEROS * size
+        self.turns = Map.INT_ZEROS * size
+        self.jump_imps = Map.INT_ZEROS * size
+        self.attack_imps = Map.INT_ZEROS * size
+        self.depth_of_field_imps = Map.INT_ZEROS * size
+        self.gain_imps = Map.INT_ZEROS * size
+        # whatever id the server sent, not necessarily an int
+        self.block_ids = [None] * size
+        self.dirty = set()
+        self.changed = set()
+        self.listeners = []
+
+        # block id -> index; Block views are only created when asked for
+        self.ids = {}
+        self.block_list = [None] * size
+        self.grid = None
+        self.blocks_by_id = None
+        self.load(map_data)
+        self.build_neighbors()
+
+    def load(self, map_data):
+        # one pass from the init message straight into the columns, with the
+        # rules of set_block_change and the heights of refresh_heights
+        width = self.width
+        ids = self.ids
+        block_ids = self.block_ids
+        types = self.types
+        min_heights = self.min_heights
+        resources = self.resources
+        heights = self.heights
+        turns = self.turns
+        jump_imps = self.jump_imps
+        attack_imps = self.attack_imps
+        depth_of_field_imps = self.depth_of_field_imps
+        gain_imps = self.gain_imps
+        block_types = set(Block.BLOCK_TYPES)
+        coefficient = Block.block_coefficient
+        max_height = Constants.BLOCK_MAX_HEIGHT
+        resource_code = Block.RESOURCE_CODE
+        mitosis_code = Block.MITOSIS_CODE
+        key_type = Constants.BLOCK_KEY_TYPE
+        key_position = Constants.GAME_OBJECT_KEY_POSITION
+        key_id = Constants.GAME_OBJECT_KEY_ID
+        key_min_height = Constants.BLOCK_KEY_MIN_HEIGHT
+        key_turn = Constants.BLOCK_KEY_TURN
         for data in map_data:
-            if Block.is_block_type(data[Constants.BLOCK_KEY_TYPE]):
-                block = Block(data)
-                pos = block.pos
-                self.blocks[pos["y"]][pos["x"]] = block
-                self.all_blocks[block.id] = block
+            type1 = data[key_type]
+            if type1 not in block_types:
+                continue
+            pos = data[key_position]
+            index = pos["y"] * width + pos["x"]
+            block_id = data[key_id]
+            ids[block_id] = index
+            block_ids[index] = block_id
+            code = ord(type1)
+            types[index] = code
+            min_height = data.get(key_min_height, 0)
+            min_heights[index] = min_height
+            turns[index] = data.get(key_turn, 0)
+            if code == resource_code:
+                resource = data.get(Constants.BLOCK_KEY_RESOURCE, 0)
+                resources[index] = resource
+                height = min_height + resource / coefficient
+            else:
+                height = min_height
+                if code == mitosis_code:
+                    jump_imps[index] = data.get(Constants.BLOCK_KEY_JUMP_IMP, 0)
+                    attack_imps[index] = data.get(Constants.BLOCK_KEY_ATTACK_IMP, 0)
+                    depth_of_field_imps[index] = data.get(Constants.BLOCK_KEY_DEPTH_OF_FIELD_IMP, 0)
+                    gain_imps[index] = data.get(Constants.BLOCK_KEY_GAIN_RATE_IMP, 0)
+            heights[index] = height if height < max_height else max_height
+
+    @property
+    def blocks(self):
+        # rows of Block views (None where there is no block), built on first use
+        if self.grid is None:
+            width = self.width
+            self.grid = [[self.block_at(y * width + x) for x in range(width)] for y in range(self.height)]
+        return self.grid
+
+    @property
+    def all_blocks(self):
+        # block id -> Block view for every block, built on first use
+        if self.blocks_by_id is None:
+            self.blocks_by_id = {block_id: self.block_at(index) for block_id, index in self.ids.items()}
+        return self.blocks_by_id
+
+    def indexes_of(self, block_type):
+        # indexes of the blocks of one type, scanning the type column
+        code = ord(block_type)
+        types = self.types
+        index = types.find(code)
+        while index >= 0:
+            yield index
+            index = types.find(code, index + 1)
+
+    def build_neighbors(self):
+        self.neighbors, self.adjacent = Map.neighbor_table(self.width, self.height)
+
+    @staticmethod
+    def neighbor_table(width, height):
+        # (dx, dy) per direction for odd and even columns, same layout as get_next_pos
+        odd_offsets = {
+            Constants.Directions.NORTH: (0, 1),
+            Constants.Directions.SOUTH: (0, -1),
+            Constants.Directions.NORTH_EAST: (1, 0),
+            Constants.Directions.NORTH_WEST: (-1, 0),
+            Constants.Directions.SOUTH_EAST: (1, -1),
+            Constants.Directions.SOUTH_WEST: (-1, -1),
+        }
+        even_offsets = {
+            Constants.Directions.NORTH: (0, 1),
+            Constants.Directions.SOUTH: (0, -1),
+            Constants.Directions.NORTH_EAST: (1, 1),
+            Constants.Directions.NORTH_WEST: (-1, 1),
+            Constants.Directions.SOUTH_EAST: (1, 0),
+            Constants.Directions.SOUTH_WEST: (-1, 0),
+        }
+        size = width * height
+        indexes = array('l', range(size))
+        neighbors = {}
+        for direction in Constants.DIRECTIONS:
+            column = array('l', [Map.NO_NEIGHBOR]) * size
+            # every other column of a row at once, leaving out the columns whose
+            # neighbour would be off the left or right edge
+            for first, offsets in ((0, even_offsets), (1, odd_offsets)):
+                dx, dy = offsets[direction]
+                start = first if first + dx >= 0 else first + 2
+                stop = width - dx if dx > 0 else width
+                if start >= stop:
+                    continue
+                for y in range(max(0, -dy), min(height, height - dy)):
+                    row = y * width
+                    next_row = (y + dy) * width + dx
+                    column[row + start:row + stop:2] = indexes[next_row + start:next_row + stop:2]
+            neighbors[direction] = column
+        return neighbors, Adjacency(neighbors)
 
     def set_change(self, data):
-        block_id = data[Constants.GAME_OBJECT_KEY_ID]
-        block = self.all_blocks.get(block_id)
-        if block is not None:
-            block.set_change(data)
+        index = self.ids.get(data[Constants.GAME_OBJECT_KEY_ID])
+        if index is not None:
+            self.set_block_change(index, data)
         return True
 
+    def apply_changes(self, statics):
+        ids = self.ids
+        set_block_change = self.set_block_change
+        for data in statics:
+            index = ids.get(data[Constants.GAME_OBJECT_KEY_ID])
+            if index is not None:
+                set_block_change(index, data)
+
+    def take_changes(self):
+        # blocks whose type, minimum height or resource changed since the last call
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    def set_block_change(self, index, data):
+        old_type = self.types[index]
+        old_height = self.height_at(index) if self.listeners else None
+        old_min_height = self.min_heights[index]
+        old_resource = self.resources[index]
+        type1 = data.get(Constants.GAME_OBJECT_KEY_TYPE)
+        if type1 is not None:
+            self.types[index] = ord(type1)
+        block_type = self.types[index]
+        min_height = data.get(Constants.BLOCK_KEY_MIN_HEIGHT)
+        if min_height is not None:
+            self.min_heights[index] = min_height
+        resource = data.get(Constants.BLOCK_KEY_RESOURCE)
+        if resource is not None:
+            if block_type == Block.RESOURCE_CODE:
+                self.resources[index] = resource
+            else:
+                self.resources[index] = 0
+        turn = data.get(Constants.BLOCK_KEY_TURN)
+        if turn is not None:
+            self.turns[index] = turn
+        is_mitosis = block_type == Block.MITOSIS_CODE
+        jump_imp = data.get(Constants.BLOCK_KEY_JUMP_IMP)
+        if jump_imp is not None:
+            self.jump_imps[index] = jump_imp if is_mitosis else 0
+        attack_imp = data.get(Constants.BLOCK_KEY_ATTACK_IMP)
+        if attack_imp is not None:
+            self.attack_imps[index] = attack_imp if is_mitosis else 0
+        depth_of_field_imp = data.get(Constants.BLOCK_KEY_DEPTH_OF_FIELD_IMP)
+        if depth_of_field_imp is not None:
+            self.depth_of_field_imps[index] = depth_of_field_imp if is_mitosis else 0
+        gain_rate_imp = data.get(Constants.BLOCK_KEY_GAIN_RATE_IMP)
+        if gain_rate_imp is not None:
+            self.gain_imps[index] = gain_rate_imp if is_mitosis else 0
+        if block_type != old_type or self.min_heights[index] != old_min_height \
+                or self.resources[index] != old_resource:
+            self.changed.add(index)
+            self.dirty.add(index)
+            for listener in self.listeners:
+                listener(index, old_type, old_height)
+
+    def add_listener(self, listener):
+        # listener(index, old_type, old_height) is called whenever set_change
+        # changes the type, height or resource of a block
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def height_at(self, index):
+        height = self.min_heights[index] + self.resources[index] / Block.block_coefficient
+        return height if height < Constants.BLOCK_MAX_HEIGHT else Constants.BLOCK_MAX_HEIGHT
+
+    def refresh_heights(self):
+        # one pass over every block touched since the last refresh
+        coefficient = Block.block_coefficient
+        min_heights = self.min_heights
+        resources = self.resources
+        heights = self.heights
+        max_height = Constants.BLOCK_MAX_HEIGHT
+        for index in self.dirty:
+            height = min_heights[index] + resources[index] / coefficient
+            heights[index] = height if height < max_height else max_height
+        self.dirty.clear()
+
+    def index_of(self, pos):
+        return pos["y"] * self.width + pos["x"]
+
+    def block_at(self, index):
+        block = self.block_list[index]
+        if block is None and self.types[index]:
+            block = self.block_list[index] = Block(self, index, self.block_ids[index])
+        return block
+
+    def neighbors_of(self, index):
+        # (direction, neighbor index) pairs that lie inside the map
+        return self.adjacent[index]
+
+    def next_index(self, direction, index):
+        return self.neighbors[direction][index]
+
+    @staticmethod
+    def hex_distance(width, a, b):
+        # moves between two block indexes on an open map: offset columns to
+        # axial coordinates, r = y - (x + 1) // 2, make every neighbour one step
+        ax = a % width
+        bx = b % width
+        dq = bx - ax
+        dr = (b // width - (bx + 1) // 2) - (a // width - (ax + 1) // 2)
+        return (abs(dq) + abs(dr) + abs(dq + dr)) // 2
+
+    def pos_of(self, index):
+        return {"x": index % self.width, "y": index // self.width}
+
     def at(self, pos):
-        return self.blocks[pos["y"]][pos["x"]]
+        return self.block_at(pos["y"] * self.width + pos["x"])
 
     def get_next_pos(self, direction, pos):
         x = pos["x"]
@@ -213,6 +588,19 @@ class Map():
                 return None
 
 
+class Adjacency(dict):
+    # block index -> ((direction, neighbor index), ...) for the neighbours inside
+    # the map, worked out from the neighbor columns the first time it is asked for
+    def __init__(self, neighbors):
+        super().__init__()
+        self.columns = [(direction, neighbors[direction]) for direction in Constants.DIRECTIONS]
+
+    def __missing__(self, index):
+        pairs = tuple((direction, column[index]) for direction, column in self.columns if column[index] >= 0)
+        self[index] = pairs
+        return pairs
+
+
 class Block():
     block_coefficient = 0
     BLOCK_TYPES = [
@@ -222,81 +610,71 @@ class Block():
         "r",
         "i",
     ]
+    # the codes of Map.types, one per type in BLOCK_TYPES
+    NONE_CODE = ord("n")
+    NORMAL_CODE = ord("o")
+    MITOSIS_CODE = ord("m")
+    RESOURCE_CODE = ord("r")
+    IMPASSABLE_CODE = ord("i")
 
-    def __init__(self, data):
-        #print(data)
-        self.id = data[Constants.GAME_OBJECT_KEY_ID]
-        self.type = None
-        self.pos = None
-        self.min_height = 0
-        self.resource = 0
-        self.turn = 0
-        self.jump_improvement_amount = 0
-        self.attack_improvement_amount = 0
-        self.depth_of_field_improvement_amount = 0
-        self.gain_improvement_amount = 0
-        self.set_change(data)
+    __slots__ = ('map', 'index', 'id')
+
+    # a thin view over one row of the Map columns
+    def __init__(self, map1, index, block_id):
+        self.map = map1
+        self.index = index
+        self.id = block_id
 
     def set_change(self, data):
-        type1 = data.get(Constants.GAME_OBJECT_KEY_TYPE)
-        if type1 is not None:
-            self.type = type1
-        pos = data.get(Constants.GAME_OBJECT_KEY_POSITION)
-        if pos is not None:
-            self.pos = pos
-        min_height = data.get(Constants.BLOCK_KEY_MIN_HEIGHT)
-        if min_height is not None:
-            self.min_height = min_height
-        resource = data.get(Constants.BLOCK_KEY_RESOURCE)
-        if resource is not None:
-            if self.type == Constants.BLOCK_TYPE_RESOURCE:
-                self.resource = resource
-            else:
-                self.resource = 0
-        turn = data.get(Constants.BLOCK_KEY_TURN)
-        if turn is not None:
-            self.turn = turn
-        jump_imp = data.get(Constants.BLOCK_KEY_JUMP_IMP)
-        if jump_imp is not None:
-            if self.type == Constants.BLOCK_TYPE_MITOSIS:
-                self.jump_improvement_amount = jump_imp
-            else:
-                self.jump_improvement_amount = 0
-        attack_imp = data.get(Constants.BLOCK_KEY_ATTACK_IMP)
-        if attack_imp is not None:
-            if self.type == Constants.BLOCK_TYPE_MITOSIS:
-                self.attack_improvement_amount = attack_imp
-            else:
-                self.attack_improvement_amount = 0
-        depth_of_field_imp = data.get(Constants.BLOCK_KEY_DEPTH_OF_FIELD_IMP)
-        if depth_of_field_imp is not None:
-            if self.type == Constants.BLOCK_TYPE_MITOSIS:
-                self.depth_of_field_improvement_amount = depth_of_field_imp
-            else:
-                self.depth_of_field_improvement_amount = 0
-        gain_rate_imp = data.get(Constants.BLOCK_KEY_GAIN_RATE_IMP)
-        if gain_rate_imp is not None:
-            if self.type == Constants.BLOCK_TYPE_MITOSIS:
-                self.gain_improvement_amount = gain_rate_imp
-            else:
-                self.gain_improvement_amount = 0
+        self.map.set_block_change(self.index, data)
+
+    @property
+    def type(self):
+        return chr(self.map.types[self.index])
+
+    @property
+    def min_height(self):
+        return self.map.min_heights[self.index]
+
+    @property
+    def resource(self):
+        return self.map.resources[self.index]
+
+    @property
+    def turn(self):
+        return self.map.turns[self.index]
+
+    @property
+    def jump_improvement_amount(self):
+        return self.map.jump_imps[self.index]
+
+    @property
+    def attack_improvement_amount(self):
+        return self.map.attack_imps[self.index]
+
+    @property
+    def depth_of_field_improvement_amount(self):
+        return self.map.depth_of_field_imps[self.index]
+
+    @property
+    def gain_improvement_amount(self):
+        return self.map.gain_imps[self.index]
+
+    @property
+    def pos(self):
+        return self.map.pos_of(self.index)
 
     def __eq__(self, other):
-        if not isinstance(other, Block):
-            return False
-        if self.pos["x"] == other.pos["x"] and self.pos["y"] == other.pos["y"]:
-            return True
-        return False
+        return isinstance(other, Block) and self.index == other.index
 
     def __hash__(self):
-        return hash((self.pos['x'], self.pos['y']))
+        return self.index
 
     @property
     def height(self):
-        height = self.min_height + self.resource / Block.block_coefficient
-        if height > Constants.BLOCK_MAX_HEIGHT:
-            height = Constants.BLOCK_MAX_HEIGHT
-        return height
+        if self.map.dirty:
+            self.map.refresh_heights()
+        return self.map.heights[self.index]
 
     @classmethod
     def is_block_type(cls, type1):
@@ -306,6 +684,102 @@ class Block():
             return False
 
 
+class Delta():
+    # what one turn message changed: block indices, and cell ids per kind of change
+    def __init__(self, turn):
+        self.turn = turn
+        self.blocks = set()
+        self.appeared = set()
+        # cell id -> block index before its first move this turn
+        self.moved = {}
+        self.hidden = set()
+        self.died = set()
+        self.forgotten = set()
+
+    def is_empty(self):
+        return not (self.blocks or self.appeared or self.moved or self.hidden or self.died or self.forgotten)
+
+
+class Sighting():
+    __slots__ = ('cell_id', 'team_id', 'index', 'energy', 'turn')
+
+    def __init__(self, cell_id, team_id, index, energy, turn):
+        self.cell_id = cell_id
+        self.team_id = team_id
+        self.index = index
+        self.energy = energy
+        self.turn = turn
+
+
+class LastSeen():
+    # where hidden cells were last observed, oldest first, bucketed into
+    # BUCKET x BUCKET squares for "who might be near here" queries
+    BUCKET = 8
+
+    def __init__(self, map1, horizon, max_size):
+        self.map = map1
+        self.horizon = horizon
+        self.max_size = max_size
+        self.sightings = OrderedDict()
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.sightings)
+
+    def get(self, cell_id):
+        return self.sightings.get(cell_id)
+
+    def bucket_of(self, index):
+        width = self.map.width
+        return (index % width // LastSeen.BUCKET, index // width // LastSeen.BUCKET)
+
+    def record(self, cell, turn):
+        self.remove(cell.id)
+        if cell.index is None:
+            return
+        self.sightings[cell.id] = Sighting(cell.id, cell.team_id, cell.index, cell.energy, turn)
+        self.buckets.setdefault(self.bucket_of(cell.index), set()).add(cell.id)
+
+    def remove(self, cell_id):
+        sighting = self.sightings.pop(cell_id, None)
+        if sighting is None:
+            return None
+        bucket = self.bucket_of(sighting.index)
+        ids = self.buckets[bucket]
+        ids.discard(cell_id)
+        if not ids:
+            self.buckets.pop(bucket)
+        return sighting
+
+    def expire(self, turn):
+        # ids of the sightings dropped for age or size
+        expired = []
+        sightings = self.sightings
+        while sightings:
+            cell_id, sighting = next(iter(sightings.items()))
+            if turn - sighting.turn <= self.horizon and len(sightings) <= self.max_size:
+                break
+            self.remove(cell_id)
+            expired.append(cell_id)
+        return expired
+
+    def near(self, index, radius, turn=None, max_age=None):
+        # sightings within radius moves of index, optionally only recent ones
+        width = self.map.width
+        x, y = index % width, index // width
+        size = LastSeen.BUCKET
+        found = []
+        for bx in range((x - radius) // size, (x + radius) // size + 1):
+            for by in range((y - radius) // size, (y + radius) // size + 1):
+                for cell_id in self.buckets.get((bx, by), ()):
+                    sighting = self.sightings[cell_id]
+                    if max_age is not None and turn - sighting.turn > max_age:
+                        continue
+                    if Map.hex_distance(width, index, sighting.index) <= radius:
+                        found.append(sighting)
+        return found
+
+
 class Event():
     TYPE_MOVE = "move"
     TYPE_ATTACK = "attack"
@@ -343,6 +817,14 @@ class Constants():
         Directions.NORTH, Directions.NORTH_EAST, Directions.SOUTH_EAST,
         Directions.SOUTH, Directions.SOUTH_WEST, Directions.NORTH_WEST,
     ]
+    REVERSE_DIRECTIONS = {
+        Directions.NORTH: Directions.SOUTH,
+        Directions.SOUTH: Directions.NORTH,
+        Directions.NORTH_EAST: Directions.SOUTH_WEST,
+        Directions.SOUTH_WEST: Directions.NORTH_EAST,
+        Directions.NORTH_WEST: Directions.SOUTH_EAST,
+        Directions.SOUTH_EAST: Directions.NORTH_WEST,
+    }
 
     KEY_ID = "id"
     KEY_TURN = "turn"
@@ -405,6 +887,16 @@ class Constants():
     CONFIG_KEY_IP = "ip"
     CONFIG_KEY_PORT = "port"
     CONFIG_KEY_TOKEN = "token"
+    CONFIG_KEY_FLUSH_INTERVAL = "flush_interval"
+    CONFIG_KEY_MAX_BATCH = "max_batch"
+    CONFIG_KEY_RECORD = "record"
+    CONFIG_KEY_METRICS = "metrics"
+    CONFIG_KEY_PROFILE_EVERY = "profile_every"
+    CONFIG_KEY_PROFILE_OUTPUT = "profile_output"
+    CONFIG_KEY_WORKERS = "workers"
+    CONFIG_KEY_SEED = "seed"
+    CONFIG_KEY_FOG_HORIZON = "fog_horizon"
+    CONFIG_KEY_FOG_MAX_CELLS = "fog_max_cells"
 
     MAP_SIZE_HEIGHT = "height"
     MAP_SIZE_WIDTH = "width"
@@ -1,22 +1,33 @@
 import socket
 import json
+from collections import deque
 from Model import Constants
+from Metrics import metrics
 
 
 class Network():
-    def __init__(self, ip, port, token, message_handler):
+    RECV_SIZE = 1 << 16
+
+    def __init__(self, ip, port, token, message_handler, recorder=None):
         self.receive_flag = True
+        self.recorder = recorder
         self.ip = ip
         self.port = port
         self.token = token
         self.message_handler = message_handler
-        self.result = b''
+        self.decoder = FrameDecoder(recorder)
+        self.frames = deque()
+        self.chunk = bytearray(Network.RECV_SIZE)
+        self.chunk_view = memoryview(self.chunk)
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def connect(self):
         try:
             self.s.connect((self.ip, self.port))
-            self.send({Constants.KEY_NAME: Constants.CONFIG_KEY_TOKEN, Constants.KEY_ARGS: [self.token]})
+            # sent around the recorder so the token never reaches the log
+            self.s.sendall(Network.encode_frames([{Constants.KEY_NAME: Constants.CONFIG_KEY_TOKEN,
+                                                   Constants.KEY_ARGS: [self.token]}]))
             init = self.receive()
             if init[Constants.KEY_NAME] == "wrong token":
                 raise ConnectionRefusedError("wrong token")
@@ -31,16 +42,30 @@ class Network():
         self.start_receiving()
 
     def send(self, message):
-        self.s.send(json.dumps(message).encode('UTF-8'))
-        self.s.send(b'\x00')
+        self.send_many([message])
+
+    def send_many(self, messages):
+        # one buffer of NUL-terminated frames, written with a single sendall
+        data = Network.encode_frames(messages)
+        if self.recorder is not None:
+            self.recorder.record_sent(data)
+        self.s.sendall(data)
+
+    @staticmethod
+    def encode_frames(messages):
+        return ("\x00".join([json.dumps(message) for message in messages]) + "\x00").encode('UTF-8')
 
     def receive(self):
         while self.receive_flag:
-            self.result += self.s.recv(1024)
-            if b'\x00' in self.result:
-                ans = json.loads(self.result[:self.result.index(b'\x00')].decode('UTF-8'))
-                self.result = self.result[self.result.index(b'\x00')+1:]
-                return ans
+            if self.frames:
+                return self.frames.popleft()
+            self.read_frames()
+
+    def read_frames(self):
+        count = self.s.recv_into(self.chunk)
+        if count == 0:
+            raise ConnectionResetError("connection closed by server")
+        self.decoder.feed(self.chunk_view[:count], self.frames)
 
     def start_receiving(self):
         import threading
@@ -62,4 +87,37 @@ class Network():
 
     def close(self):
         self.terminate()
-        self.s.close()
\ No newline at end of file
+        self.s.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+class FrameDecoder():
+    def __init__(self, recorder=None):
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.recorder = recorder
+        self.frame_started = None
+
+    def feed(self, data, frames):
+        # appends every complete message to frames; bytes before
+        # self.scanned are known to hold no delimiter
+        if not self.buffer:
+            # receive time runs from the first byte of a frame to its delimiter
+            self.frame_started = metrics.clock()
+        self.buffer += data
+        start = 0
+        end = self.buffer.find(b'\x00', self.scanned)
+        while end != -1:
+            metrics.add('network.receive', self.frame_started)
+            frame = self.buffer[start:end]
+            if self.recorder is not None:
+                self.recorder.record_received(frame)
+            started = metrics.clock()
+            frames.append(json.loads(frame.decode('UTF-8')))
+            metrics.add('network.decode', started)
+            self.frame_started = metrics.clock()
+            start = end + 1
+            end = self.buffer.find(b'\x00', start)
+        if start:
+            del self.buffer[:start]
+        self.scanned = len(self.buffer)
@@ -0,0 +1,314 @@
+import multiprocessing
+import time
+import traceback
+from array import array
+from collections import deque
+from multiprocessing import shared_memory
+from Model import Map, Block
+from Metrics import metrics
+
+
+class Snapshot():
+    # terrain and occupancy columns in one shared memory block: types and
+    # occupancy as bytes, then min heights, resources and heights as doubles,
+    # then the generation of the tasks allowed to read them
+    def __init__(self, width, height, name=None):
+        self.width = width
+        self.height = height
+        size = self.size = width * height
+        float_offset = (2 * size + 7) // 8 * 8
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=float_offset + 3 * 8 * size + 8)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.owner = name is None
+        buf = self.memory.buf
+        self.types = buf[0:size]
+        self.occupied = buf[size:2 * size]
+        self.min_heights = buf[float_offset:float_offset + 8 * size].cast('d')
+        self.resources = buf[float_offset + 8 * size:float_offset + 16 * size].cast('d')
+        self.heights = buf[float_offset + 16 * size:float_offset + 24 * size].cast('d')
+        self.generation = buf[float_offset + 24 * size:float_offset + 24 * size + 8].cast('q')
+        self.adjacent = None
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write_terrain(self, world_map):
+        world_map.refresh_heights()
+        self.types[:] = world_map.types
+        self.min_heights[:] = array('d', world_map.min_heights)
+        self.resources[:] = array('d', world_map.resources)
+        self.heights[:] = world_map.heights
+
+    def write_blocks(self, world_map, indexes):
+        world_map.refresh_heights()
+        for index in indexes:
+            self.types[index] = world_map.types[index]
+            self.min_heights[index] = world_map.min_heights[index]
+            self.resources[index] = world_map.resources[index]
+            self.heights[index] = world_map.heights[index]
+
+    def release(self):
+        # exported views have to go before the block can be closed
+        for view in (self.types, self.occupied, self.min_heights, self.resources, self.heights, self.generation):
+            view.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class ParallelPlanner():
+    # plans the goal searches of many cells in a process pool; results are
+    # candidate lists, the claims are left to the caller
+    CANDIDATES = 8
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.world = None
+        self.snapshot = None
+        self.pool = None
+        self.changed = set()
+        self.occupied = []
+        self.generation = 0
+        # results of the last plan, possibly still running past its deadline
+        self.pending = []
+
+    def attach(self, world):
+        if self.world is world:
+            return
+        self.close()
+        self.world = world
+        self.snapshot = Snapshot(world.map.width, world.map.height)
+        self.snapshot.write_terrain(world.map)
+        world.subscribe(self.on_turn)
+        # concurrent.futures refuses new work once the main thread has exited,
+        # which is how Controller runs, so this is a multiprocessing pool
+        self.pool = multiprocessing.get_context('spawn').Pool(
+            self.workers, initializer=init_worker,
+            initargs=(self.snapshot.name, world.map.width, world.map.height))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.snapshot is not None:
+            self.snapshot.release()
+            self.snapshot = None
+        if self.world is not None:
+            self.world.unsubscribe(self.on_turn)
+            self.world = None
+        self.changed = set()
+        self.occupied = []
+        self.pending = []
+
+    def on_turn(self, delta):
+        self.changed |= delta.blocks
+
+    def retire(self):
+        # stale tasks stop at their next check; the columns are only rewritten
+        # once none of them can still be reading
+        self.generation += 1
+        self.snapshot.generation[0] = self.generation
+        for result in self.pending:
+            result.wait()
+        self.pending = []
+
+    def publish(self):
+        snapshot = self.snapshot
+        if self.changed:
+            snapshot.write_blocks(self.world.map, self.changed)
+            self.changed = set()
+        occupied = snapshot.occupied
+        for index in self.occupied:
+            occupied[index] = 0
+        self.occupied = list(self.world.all_cells_by_pos)
+        for index in self.occupied:
+            occupied[index] = 1
+
+    def plan(self, world, tasks, timeout=None):
+        # tasks are (cell id, block index, jump, gain rate, goal block type or None);
+        # returns cell id -> (candidates, more, explore, explore_more) for the
+        # tasks finished within timeout
+        if not tasks:
+            return {}
+        self.attach(world)
+        started = metrics.clock()
+        self.retire()
+        self.publish()
+        metrics.add('planner.publish', started)
+
+        started = metrics.clock()
+        deadline = None if timeout is None else time.time() + timeout
+        chunks = min(len(tasks), self.workers * 4)
+        results = [self.pool.apply_async(plan_cells, (self.generation, tasks[i::chunks])) for i in range(chunks)]
+        plans = {}
+        for result in results:
+            result.wait(None if deadline is None else max(0, deadline - time.time()))
+            if not result.ready():
+                continue
+            try:
+                planned = result.get()
+            except Exception as e:
+                # a crash in a worker, not a timeout: report it, its cells fall back
+                traceback.print_exception(e)
+                continue
+            for cell_id, plan in planned:
+                plans[cell_id] = plan
+        self.pending = [result for result in results if not result.ready()]
+        if self.pending:
+            # past the deadline: tell the leftovers to stop now
+            self.generation += 1
+            self.snapshot.generation[0] = self.generation
+        metrics.add('planner.plan', started)
+        return plans
+
+
+snapshot = None
+
+
+def init_worker(name, width, height):
+    global snapshot
+    snapshot = Snapshot(width, height, name)
+    neighbors, snapshot.adjacent = Map.neighbor_table(width, height)
+
+
+def plan_cells(generation, tasks):
+    results = []
+    for cell_id, index, jump, gain_rate, goal_type in tasks:
+        # a newer plan has started or the deadline passed
+        if snapshot.generation[0] != generation:
+            break
+        results.append((cell_id, plan_cell(snapshot, index, jump, gain_rate, goal_type)))
+    return results
+
+
+def plan_cell(snapshot, index, jump, gain_rate, goal_type):
+    reach = None
+    candidates, more = [], False
+    if goal_type is not None:
+        candidates, more = search_goals(snapshot, index, jump, gain_rate, ord(goal_type))
+        # both the goal and the first step must have a way back, as AI.try_mitosis
+        # and AI.try_resource check
+        for i, (goal, direction, step) in enumerate(candidates):
+            ok = False
+            if direction is not None:
+                if reach is None:
+                    reach = reach_to(snapshot, index, jump)
+                ok = can_return(snapshot, goal, index, jump, reach) \
+                    and can_return(snapshot, step, index, jump, reach)
+            candidates[i] = (goal, direction, step, ok)
+
+    # exploring is only needed when no candidate can be taken
+    if any(direction is not None and ok for goal, direction, step, ok in candidates):
+        return candidates, more, None, False
+    explore, explore_more = search_goals(snapshot, index, jump, gain_rate, Block.NONE_CODE)
+    for i, (goal, direction, step) in enumerate(explore):
+        ok = False
+        if direction is not None:
+            if reach is None:
+                reach = reach_to(snapshot, index, jump)
+            ok = can_return(snapshot, step, index, jump, reach)
+        explore[i] = (goal, direction, step, ok)
+    return candidates, more, explore, explore_more
+
+
+def search_goals(snapshot, start, jump, gain_rate, goal_code):
+    # the BFS of AI.get_next_to_type without the claims: the nearest goals in
+    # order, each with the first step towards it
+    types = snapshot.types
+    heights = snapshot.heights
+    occupied = snapshot.occupied
+    adjacent = snapshot.adjacent
+    impassable = Block.IMPASSABLE_CODE
+    none = Block.NONE_CODE
+    resource = Block.RESOURCE_CODE
+    allow_none = goal_code == none
+    first = {start: None}
+    found = []
+    q = deque([start])
+    while q:
+        index = q.popleft()
+        if types[index] == goal_code \
+                and (goal_code != resource or can_gain(snapshot, index, jump, gain_rate)):
+            if goal_code == resource and occupied[index]:
+                continue
+            step = first[index]
+            if step is None:
+                found.append((index, None, None))
+            else:
+                found.append((index, step[0], step[1]))
+            if len(found) >= ParallelPlanner.CANDIDATES:
+                return found, True
+
+        height = heights[index]
+        step = first[index]
+        for direction, next_index in adjacent[index]:
+            if next_index in first:
+                continue
+            next_type = types[next_index]
+            if next_type == 0 or next_type == impassable or (next_type == none and not allow_none):
+                continue
+            if heights[next_index] - height > jump:
+                continue
+            first[next_index] = step or (direction, next_index)
+            q.append(next_index)
+    return found, False
+
+
+def reach_to(snapshot, target, jump):
+    # blocks from which AI.search_path finds a way to target
+    types = snapshot.types
+    heights = snapshot.heights
+    occupied = snapshot.occupied
+    adjacent = snapshot.adjacent
+    impassable = Block.IMPASSABLE_CODE
+    none = Block.NONE_CODE
+    reach = {target}
+    q = deque([target])
+    while q:
+        index = q.popleft()
+        height = heights[index]
+        for direction, prev in adjacent[index]:
+            if prev in reach:
+                continue
+            prev_type = types[prev]
+            if prev_type == 0 or prev_type == impassable or prev_type == none or occupied[prev]:
+                continue
+            if height - heights[prev] > jump:
+                continue
+            reach.add(prev)
+            q.append(prev)
+    return reach
+
+
+def can_return(snapshot, start, target, jump, reach):
+    if start == target:
+        return False
+    if start in reach:
+        return True
+    heights = snapshot.heights
+    height = heights[start]
+    for direction, next_index in snapshot.adjacent[start]:
+        if next_index in reach and heights[next_index] - height <= jump:
+            return True
+    return False
+
+
+def can_gain(snapshot, index, jump, gain_rate):
+    # same estimate as AI.should_gain_resource
+    resource = snapshot.resources[index]
+    if resource == 0:
+        return False
+    new_height = min(9, snapshot.min_heights[index] + max(0, resource - gain_rate) / 50)
+    height = new_height or snapshot.heights[index]
+    types = snapshot.types
+    heights = snapshot.heights
+    for direction, next_index in snapshot.adjacent[index]:
+        next_type = types[next_index]
+        if next_type and next_type != Block.IMPASSABLE_CODE and next_type != Block.NONE_CODE \
+                and heights[next_index] - height <= jump:
+            return True
+    return False
@@ -0,0 +1,1102 @@
+import random
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from heapq import heappush, heappop
+from math import ceil
+from Model import Map, Block, Constants
+
+
+class DistanceField():
+    UNREACHABLE = -1
+
+    # multi-source BFS over reversed moves: for every block, the distance to the
+    # nearest source, the first step towards it and which source it leads to
+    def __init__(self, world_map, sources, jump, allow_none=False):
+        world_map.refresh_heights()
+        size = world_map.width * world_map.height
+        self.map = world_map
+        self.jump = jump
+        self.allow_none = allow_none
+        self.dist = array('l', [DistanceField.UNREACHABLE]) * size
+        self.goal = array('l', [DistanceField.UNREACHABLE]) * size
+        self.step = [None] * size
+        self.build(sources, allow_none)
+
+    def build(self, sources, allow_none):
+        types = self.map.types
+        heights = self.map.heights
+        adjacent = self.map.adjacent
+        reverse = Constants.REVERSE_DIRECTIONS
+        dist = self.dist
+        goal = self.goal
+        step = self.step
+        jump = self.jump
+        impassable = Block.IMPASSABLE_CODE
+        none = Block.NONE_CODE
+
+        q = deque()
+        for index in sources:
+            if dist[index] < 0:
+                dist[index] = 0
+                goal[index] = index
+                q.append(index)
+
+        while q:
+            index = q.popleft()
+            height = heights[index]
+            next_dist = dist[index] + 1
+            for direction, prev in adjacent[index]:
+                if dist[prev] >= 0 or types[prev] == 0:
+                    continue
+                # prev -> index must be a legal climb for this jump
+                if height - heights[prev] > jump:
+                    continue
+                dist[prev] = next_dist
+                goal[prev] = goal[index]
+                step[prev] = reverse[direction]
+                prev_type = types[prev]
+                # only blocks a cell may walk onto can be intermediate nodes
+                if prev_type != impassable and (prev_type != none or allow_none):
+                    q.append(prev)
+
+    def remove_source(self, source):
+        # only the blocks that led to source change: clear them, then refill
+        # them from the blocks around them, nearest first
+        if self.goal[source] != source or self.dist[source] != 0:
+            return
+        types = self.map.types
+        heights = self.map.heights
+        adjacent = self.map.adjacent
+        reverse = Constants.REVERSE_DIRECTIONS
+        dist = self.dist
+        goal = self.goal
+        step = self.step
+        jump = self.jump
+        impassable = Block.IMPASSABLE_CODE
+        none = Block.NONE_CODE
+        allow_none = self.allow_none
+
+        region = [source]
+        goal[source] = DistanceField.UNREACHABLE
+        for index in region:
+            for direction, prev in adjacent[index]:
+                if goal[prev] == source:
+                    goal[prev] = DistanceField.UNREACHABLE
+                    region.append(prev)
+        for index in region:
+            dist[index] = DistanceField.UNREACHABLE
+            step[index] = None
+
+        # blocks next to the region that the BFS in build() expanded from
+        q = []
+        for index in region:
+            height = heights[index]
+            for direction, next_index in adjacent[index]:
+                if dist[next_index] < 0 or heights[next_index] - height > jump:
+                    continue
+                next_type = types[next_index]
+                if dist[next_index] == 0 or (next_type != impassable and (next_type != none or allow_none)):
+                    heappush(q, (dist[next_index], next_index))
+
+        while q:
+            index_dist, index = heappop(q)
+            height = heights[index]
+            next_dist = index_dist + 1
+            for direction, prev in adjacent[index]:
+                if dist[prev] >= 0 or types[prev] == 0:
+                    continue
+                if height - heights[prev] > jump:
+                    continue
+                dist[prev] = next_dist
+                goal[prev] = goal[index]
+                step[prev] = reverse[direction]
+                prev_type = types[prev]
+                if prev_type != impassable and (prev_type != none or allow_none):
+                    heappush(q, (next_dist, prev))
+
+    def distance(self, index):
+        return self.dist[index]
+
+    def next_step(self, index):
+        # (direction, next block index) or None when unreachable or already there
+        if self.dist[index] <= 0:
+            return None
+        direction = self.step[index]
+        return direction, self.map.next_index(direction, index)
+
+    def goal_of(self, index):
+        return self.goal[index]
+
+
+class DistanceFields():
+    # per-turn cache of DistanceField objects, one per (block type, cell group)
+    def __init__(self):
+        self.fields = {}
+        self.turn = None
+
+    def reset(self, turn):
+        if turn != self.turn:
+            self.fields = {}
+            self.turn = turn
+
+    def get(self, key, build):
+        field = self.fields.get(key)
+        if field is None:
+            field = build()
+            self.fields[key] = field
+        return field
+
+
+class PathSearch():
+    # point-to-point searches for one cell with the move rules of AI.search_path;
+    # paths are lists of (direction, block index) steps, None when unreachable
+    def __init__(self, world, cell):
+        world.map.refresh_heights()
+        self.world = world
+        self.map = world.map
+        self.cell_id = cell.id
+        self.jump = cell.jump
+        self.expanded = 0
+
+    hex_distance = staticmethod(Map.hex_distance)
+
+    def passable(self, index):
+        block_type = self.map.types[index]
+        if block_type == 0 or block_type == Block.IMPASSABLE_CODE or block_type == Block.NONE_CODE:
+            return False
+        occupant = self.world.cell_at(index)
+        return occupant is None or occupant.id == self.cell_id
+
+    def a_star(self, start, end):
+        if start == end:
+            return None
+        width = self.map.width
+        heights = self.map.heights
+        adjacent = self.map.adjacent
+        jump = self.jump
+        hex_distance = PathSearch.hex_distance
+        if not self.passable(end):
+            return None
+
+        # (f, h, order, index): ties go to the block nearer the goal
+        came = {start: None}
+        cost = {start: 0}
+        h = hex_distance(width, start, end)
+        heap = [(h, h, 0, start)]
+        order = 0
+        closed = set()
+        while heap:
+            f, h, o, index = heappop(heap)
+            if index == end:
+                return PathSearch.unwind(came, end)
+            if index in closed:
+                continue
+            closed.add(index)
+            self.expanded += 1
+            height = heights[index]
+            next_cost = cost[index] + 1
+            for direction, next_index in adjacent[index]:
+                if next_index in closed or cost.get(next_index, next_cost + 1) <= next_cost:
+                    continue
+                if heights[next_index] - height > jump or not self.passable(next_index):
+                    continue
+                cost[next_index] = next_cost
+                came[next_index] = (direction, index)
+                order += 1
+                h = hex_distance(width, next_index, end)
+                heappush(heap, (next_cost + h, h, order, next_index))
+        return None
+
+    def bidirectional(self, start, end):
+        # breadth-first from both ends, always growing the smaller frontier
+        if start == end or not self.passable(end):
+            return None
+        heights = self.map.heights
+        adjacent = self.map.adjacent
+        jump = self.jump
+        forward = {start: None}
+        backward = {end: None}
+        forward_frontier = [start]
+        backward_frontier = [end]
+        while forward_frontier and backward_frontier:
+            if len(forward_frontier) <= len(backward_frontier):
+                next_frontier = []
+                for index in forward_frontier:
+                    self.expanded += 1
+                    height = heights[index]
+                    for direction, next_index in adjacent[index]:
+                        if next_index in forward:
+                            continue
+                        if heights[next_index] - height > jump or not self.passable(next_index):
+                            continue
+                        forward[next_index] = (direction, index)
+                        if next_index in backward:
+                            return PathSearch.join(forward, backward, next_index)
+                        next_frontier.append(next_index)
+                forward_frontier = next_frontier
+            else:
+                next_frontier = []
+                for index in backward_frontier:
+                    self.expanded += 1
+                    height = heights[index]
+                    for direction, prev in adjacent[index]:
+                        if prev in backward:
+                            continue
+                        # prev -> index must be a legal move; the start itself is never checked
+                        if height - heights[prev] > jump or (prev != start and not self.passable(prev)):
+                            continue
+                        backward[prev] = (Constants.REVERSE_DIRECTIONS[direction], index)
+                        if prev in forward:
+                            return PathSearch.join(forward, backward, prev)
+                        next_frontier.append(prev)
+                backward_frontier = next_frontier
+        return None
+
+    @staticmethod
+    def unwind(came, index):
+        path = []
+        while came[index] is not None:
+            direction, parent = came[index]
+            path.append((direction, index))
+            index = parent
+        path.reverse()
+        return path
+
+    @staticmethod
+    def join(forward, backward, meet):
+        path = PathSearch.unwind(forward, meet)
+        index = meet
+        while backward[index] is not None:
+            direction, index = backward[index]
+            path.append((direction, index))
+        return path
+
+
+class Components():
+    # strongly connected components of the move graph between walkable blocks
+    # for one jump level, repaired in place when edges flip. position is a
+    # topological order of the components (every edge of the condensation goes
+    # from a lower to a higher position) kept the way Pearce and Kelly's
+    # dynamic topological sort does; order holds the positions in use, sorted
+    def __init__(self, adjacent, heights, walkable, jump):
+        self.adjacent = adjacent
+        self.heights = heights
+        self.walkable = walkable
+        self.jump = jump
+        self.component = array('l', [-1]) * len(walkable)
+        # per component id, None once the id is free again
+        self.members = []
+        self.successors = []
+        self.predecessors = []
+        self.position = []
+        self.free = []
+        self.order = []
+        self.closure = {}
+        self.build()
+
+    def build(self):
+        walkable = self.walkable
+        # Tarjan numbers sinks first
+        groups = self.strong_components(range(len(walkable)), walkable)
+        for position, group in enumerate(reversed(groups)):
+            self.add_component(group, position)
+        adjacent = self.adjacent
+        heights = self.heights
+        component = self.component
+        jump = self.jump
+        link = self.link
+        for index in range(len(walkable)):
+            source = component[index]
+            if source < 0:
+                continue
+            height = heights[index]
+            for direction, next_index in adjacent[index]:
+                target = component[next_index]
+                if target >= 0 and target != source and heights[next_index] - height <= jump:
+                    link(source, target, 1)
+
+    def strong_components(self, roots, inside):
+        # Tarjan over the blocks set in inside, sinks first
+        adjacent = self.adjacent
+        heights = self.heights
+        jump = self.jump
+        size = len(inside)
+        order = array('l', [-1]) * size
+        low = array('l', [0]) * size
+        on_stack = bytearray(size)
+        stack = []
+        groups = []
+        counter = 0
+        for root in roots:
+            if not inside[root] or order[root] >= 0:
+                continue
+            order[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [(root, iter(adjacent[root]))]
+            while work:
+                index, edges = work[-1]
+                height = heights[index]
+                for direction, next_index in edges:
+                    if not inside[next_index] or heights[next_index] - height > jump:
+                        continue
+                    if order[next_index] < 0:
+                        order[next_index] = low[next_index] = counter
+                        counter += 1
+                        stack.append(next_index)
+                        on_stack[next_index] = 1
+                        work.append((next_index, iter(adjacent[next_index])))
+                        break
+                    if on_stack[next_index] and order[next_index] < low[index]:
+                        low[index] = order[next_index]
+                else:
+                    work.pop()
+                    if work and low[index] < low[work[-1][0]]:
+                        low[work[-1][0]] = low[index]
+                    if low[index] == order[index]:
+                        group = []
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = 0
+                            group.append(member)
+                            if member == index:
+                                break
+                        groups.append(group)
+        return groups
+
+    def add_component(self, group, position):
+        if self.free:
+            new = self.free.pop()
+            self.members[new] = set(group)
+            self.successors[new] = {}
+            self.predecessors[new] = {}
+            self.position[new] = position
+        else:
+            new = len(self.members)
+            self.members.append(set(group))
+            self.successors.append({})
+            self.predecessors.append({})
+            self.position.append(position)
+        insort(self.order, position)
+        component = self.component
+        for index in group:
+            component[index] = new
+        return new
+
+    def retire(self, old):
+        self.release(self.position[old])
+        self.members[old] = None
+        self.successors[old] = None
+        self.predecessors[old] = None
+        self.position[old] = None
+        self.free.append(old)
+
+    def release(self, position):
+        order = self.order
+        del order[bisect_left(order, position)]
+
+    def link(self, source, target, count):
+        # count edges from source to target are added (or removed when negative)
+        successors = self.successors[source]
+        total = successors.get(target, 0) + count
+        if total:
+            successors[target] = total
+            self.predecessors[target][source] = total
+        else:
+            successors.pop(target, None)
+            self.predecessors[target].pop(source, None)
+
+    def edge(self, a, b):
+        walkable = self.walkable
+        return walkable[a] and walkable[b] and self.heights[b] - self.heights[a] <= self.jump
+
+    def repair(self, removed, added, lost, gained):
+        # removed and added are the edges (a, b) that flipped, lost and gained the
+        # blocks that stopped or started being walkable; heights and walkable
+        # already describe the new terrain. Only the components these touch are
+        # split, merged or moved in the order.
+        component = self.component
+        lost = set(lost)
+        pairs = {}
+        for a, b in removed:
+            source = component[a]
+            target = component[b]
+            if source != target:
+                self.link(source, target, -1)
+            elif a not in lost and b not in lost:
+                # a must still reach b inside the component
+                pairs.setdefault(source, []).append((a, b))
+        gone = {}
+        for index in lost:
+            old = component[index]
+            component[index] = -1
+            self.members[old].discard(index)
+            gone.setdefault(old, []).append(index)
+        for old in gone:
+            if self.members[old]:
+                pairs.setdefault(old, [])
+            else:
+                self.retire(old)
+                pairs.pop(old, None)
+        # edges added this turn are counted below, not by the splits
+        fresh = set(added)
+        for old, checks in pairs.items():
+            self.split(old, checks, gone.get(old, ()), fresh)
+        for index in gained:
+            self.add_component([index], self.order[-1] + 1 if self.order else 0)
+        for a, b in added:
+            source = component[a]
+            target = component[b]
+            if source == target:
+                continue
+            self.link(source, target, 1)
+            if self.position[source] > self.position[target]:
+                self.reorder(source, target)
+        self.closure = {}
+
+    def split(self, old, pairs, gone, fresh):
+        # peel off the parts of the component that can no longer get back to the
+        # rest (or be reached from it) until every pair is joined inside what is
+        # left, together with the blocks around everything that left
+        component = self.component
+        adjacent = self.adjacent
+        boundary = set(gone)
+        while True:
+            checks = [(a, b) for a, b in pairs if component[a] == old and component[b] == old]
+            # a path that used the blocks that left now has to go around the
+            # touching group of them it went through
+            seen = set()
+            for index in boundary:
+                if index in seen:
+                    continue
+                seen.add(index)
+                group = [index]
+                near = []
+                for member in group:
+                    for direction, next_index in adjacent[member]:
+                        if next_index in boundary:
+                            if next_index not in seen:
+                                seen.add(next_index)
+                                group.append(next_index)
+                        elif component[next_index] == old and next_index not in near:
+                            near.append(next_index)
+                for next_index in near[1:]:
+                    checks.append((near[0], next_index))
+                    checks.append((next_index, near[0]))
+            for a, b in checks:
+                closed, forward = self.join(old, a, b)
+                if closed is not None:
+                    break
+            else:
+                return
+            self.peel(old, closed, forward, fresh)
+            boundary.update(closed)
+
+    def join(self, old, a, b):
+        # forward from a and backward from b inside the component, one block at
+        # a time each; the side that runs out first is closed: nothing leaves it
+        # (forward) or enters it (backward) within the component
+        if a == b:
+            return None, True
+        component = self.component
+        adjacent = self.adjacent
+        heights = self.heights
+        jump = self.jump
+        ahead = {a}
+        behind = {b}
+        ahead_queue = deque([a])
+        behind_queue = deque([b])
+        while ahead_queue and behind_queue:
+            index = ahead_queue.popleft()
+            height = heights[index]
+            for direction, next_index in adjacent[index]:
+                if next_index not in ahead and component[next_index] == old and heights[next_index] - height <= jump:
+                    if next_index in behind:
+                        return None, True
+                    ahead.add(next_index)
+                    ahead_queue.append(next_index)
+            index = behind_queue.popleft()
+            height = heights[index]
+            for direction, next_index in adjacent[index]:
+                if next_index not in behind and component[next_index] == old and height - heights[next_index] <= jump:
+                    if next_index in ahead:
+                        return None, True
+                    behind.add(next_index)
+                    behind_queue.append(next_index)
+        if not ahead_queue:
+            return ahead, True
+        return behind, False
+
+    def peel(self, old, closed, forward, fresh):
+        component = self.component
+        inside = bytearray(len(component))
+        for index in closed:
+            inside[index] = 1
+        groups = self.strong_components(closed, inside)
+        self.members[old] -= closed
+        # a closed forward part comes right after the rest of the component in
+        # the order, a closed backward part right before it, sources first
+        order = self.order
+        place = self.position[old]
+        if forward:
+            at = bisect_right(order, place)
+            low = place
+            high = order[at] if at < len(order) else place + len(groups) + 1
+        else:
+            at = bisect_left(order, place)
+            low = order[at - 1] if at > 0 else place - len(groups) - 1
+            high = place
+        step = (high - low) / (len(groups) + 1)
+        if low + step == low or high - step == high:
+            self.renumber()
+            return self.peel(old, closed, forward, fresh)
+        pieces = set()
+        for number, group in enumerate(reversed(groups)):
+            pieces.add(self.add_component(group, low + step * (number + 1)))
+        edge = self.edge
+        link = self.link
+        for index in closed:
+            source = component[index]
+            for direction, next_index in self.adjacent[index]:
+                target = component[next_index]
+                if target < 0 or target == source:
+                    continue
+                outgoing = edge(index, next_index) and (index, next_index) not in fresh
+                if target in pieces:
+                    if outgoing:
+                        link(source, target, 1)
+                    continue
+                # edges to the rest of the component become cross edges, edges to
+                # other components move from the old component to the piece
+                if outgoing:
+                    if target != old:
+                        link(old, target, -1)
+                    link(source, target, 1)
+                if edge(next_index, index) and (next_index, index) not in fresh:
+                    if target != old:
+                        link(target, old, -1)
+                    link(target, source, 1)
+
+    def renumber(self):
+        # spread the positions back out to whole numbers
+        ordered = sorted((position, current) for current, position in enumerate(self.position)
+                         if position is not None)
+        for position, (old_position, current) in enumerate(ordered):
+            self.position[current] = position
+        self.order = list(range(len(ordered)))
+
+    def reorder(self, source, target):
+        # a new edge source -> target against the order: search the window
+        # between them, merge any cycle it closed and move the rest apart
+        position = self.position
+        lower = position[target]
+        upper = position[source]
+        forward = {target}
+        work = [target]
+        while work:
+            current = work.pop()
+            for next_component in self.successors[current]:
+                if next_component not in forward and position[next_component] <= upper:
+                    forward.add(next_component)
+                    work.append(next_component)
+        backward = {source}
+        work = [source]
+        while work:
+            current = work.pop()
+            for next_component in self.predecessors[current]:
+                if next_component not in backward and position[next_component] >= lower:
+                    backward.add(next_component)
+                    work.append(next_component)
+        pool = sorted(position[current] for current in forward | backward)
+        if source in forward:
+            cycle = forward & backward
+            before = sorted(backward - cycle, key=position.__getitem__)
+            after = sorted(forward - cycle, key=position.__getitem__)
+            kept = self.merge(cycle)
+            order = before + [kept] + after
+            # the merged components leave their places
+            for place in pool[len(before) + 1:len(pool) - len(after)]:
+                self.release(place)
+            places = pool[:len(before) + 1] + pool[len(pool) - len(after):]
+        else:
+            order = sorted(backward, key=position.__getitem__) + sorted(forward, key=position.__getitem__)
+            places = pool
+        for current, place in zip(order, places):
+            position[current] = place
+
+    def merge(self, cycle):
+        # the components of a new cycle become one, kept under the largest id
+        members = self.members
+        kept = max(cycle, key=lambda current: len(members[current]))
+        component = self.component
+        for current in cycle:
+            if current == kept:
+                continue
+            for index in members[current]:
+                component[index] = kept
+            members[kept] |= members[current]
+            for target, count in self.successors[current].items():
+                del self.predecessors[target][current]
+                if target not in cycle:
+                    self.link(kept, target, count)
+            for source, count in self.predecessors[current].items():
+                del self.successors[source][current]
+                if source not in cycle:
+                    self.link(source, kept, count)
+            self.members[current] = None
+            self.successors[current] = None
+            self.predecessors[current] = None
+            self.position[current] = None
+            self.free.append(current)
+        return kept
+
+    def reachable(self, source):
+        # bit set of the components reachable from source, memoised per component
+        closure = self.closure
+        if source in closure:
+            return closure[source]
+        work = [source]
+        while work:
+            current = work[-1]
+            pending = [target for target in self.successors[current] if target not in closure]
+            if pending:
+                work.extend(pending)
+                continue
+            work.pop()
+            if current in closure:
+                continue
+            bits = 1 << current
+            for target in self.successors[current]:
+                bits |= closure[target]
+            closure[current] = bits
+        return closure[source]
+
+
+class Reachability():
+    """Terrain-only answers to "does AI.search_path find a way from start to end"
+    for a given jump.
+
+    Other cells are ignored: search_path will not step onto a block another
+    cell stands on, so a path blocked only by cells is still reachable here
+    while search_path finds none. Callers that need the occupied answer must
+    use search_path.
+    """
+    # components are built per jump level on first use and then repaired from
+    # the edges each turn's changed blocks flip
+    def __init__(self):
+        self.world = None
+        self.levels = {}
+        self.heights = None
+        self.walkable = None
+        self.builds = 0
+        self.repairs = 0
+
+    def attach(self, world):
+        if self.world is world:
+            return
+        if self.world is not None:
+            self.world.unsubscribe(self.on_turn)
+        self.world = world
+        self.levels = {}
+        world.map.refresh_heights()
+        self.heights = array('d', world.map.heights)
+        self.walkable = bytearray(len(world.map.types))
+        for index in range(len(self.walkable)):
+            self.walkable[index] = Reachability.is_walkable(world.map.types[index])
+        world.subscribe(self.on_turn)
+
+    @staticmethod
+    def is_walkable(block_type):
+        return block_type != 0 and block_type != Block.IMPASSABLE_CODE \
+            and block_type != Block.NONE_CODE
+
+    def on_turn(self, delta):
+        if not delta.blocks:
+            return
+        world_map = self.world.map
+        world_map.refresh_heights()
+        old_heights = {index: self.heights[index] for index in delta.blocks}
+        old_walkable = {index: self.walkable[index] for index in delta.blocks}
+        for index in delta.blocks:
+            self.heights[index] = world_map.heights[index]
+            self.walkable[index] = Reachability.is_walkable(world_map.types[index])
+        lost = [index for index in delta.blocks if old_walkable[index] and not self.walkable[index]]
+        gained = [index for index in delta.blocks if self.walkable[index] and not old_walkable[index]]
+        for jump, components in self.levels.items():
+            removed, added = self.flips(delta.blocks, jump, old_heights, old_walkable)
+            if removed or added or lost or gained:
+                components.repair(removed, added, lost, gained)
+                self.repairs += 1
+
+    def flips(self, indexes, jump, old_heights, old_walkable):
+        # the edges around the changed blocks that appeared or disappeared
+        heights = self.heights
+        walkable = self.walkable
+        adjacent = self.world.map.adjacent
+        removed = []
+        added = []
+        seen = set()
+        for index in indexes:
+            for direction, next_index in adjacent[index]:
+                for a, b in ((index, next_index), (next_index, index)):
+                    if (a, b) in seen:
+                        continue
+                    seen.add((a, b))
+                    old = old_walkable.get(a, walkable[a]) and old_walkable.get(b, walkable[b]) \
+                        and old_heights.get(b, heights[b]) - old_heights.get(a, heights[a]) <= jump
+                    new = walkable[a] and walkable[b] and heights[b] - heights[a] <= jump
+                    if old and not new:
+                        removed.append((a, b))
+                    elif new and not old:
+                        added.append((a, b))
+        return removed, added
+
+    def level(self, jump):
+        components = self.levels.get(jump)
+        if components is None:
+            components = Components(self.world.map.adjacent, self.heights, self.walkable, jump)
+            self.levels[jump] = components
+            self.builds += 1
+        return components
+
+    def can_reach(self, start, end, jump):
+        # the start block itself is never checked by the search, only where it can step
+        if start == end or not self.walkable[end]:
+            return False
+        components = self.level(jump)
+        component = components.component
+        target = component[end]
+        if self.walkable[start]:
+            return bool(components.reachable(component[start]) >> target & 1)
+        heights = self.heights
+        height = heights[start]
+        for direction, next_index in self.world.map.adjacent[start]:
+            if self.walkable[next_index] and heights[next_index] - height <= jump \
+                    and components.reachable(component[next_index]) >> target & 1:
+                return True
+        return False
+
+
+class TargetAssignment():
+    # goal blocks for a group of cells that move alike, assigned greedily by
+    # distance: every round is one multi-source field over the goals still free,
+    # and the cells whose nearest goal was taken by a closer cell wait for the next
+    MAX_ROUNDS = 8
+    # small groups are solved exactly over the goals the greedy rounds touched
+    HUNGARIAN_MAX = 8
+
+    def __init__(self, world_map, jump, sources, allow_none=False):
+        self.map = world_map
+        self.jump = jump
+        self.sources = set(sources)
+        self.allow_none = allow_none
+        self.fields = 0
+
+    def field(self, sources):
+        self.fields += 1
+        return DistanceField(self.map, sources, self.jump, self.allow_none)
+
+    def assign(self, cells):
+        # cells are (cell id, block index); returns cell id -> (goal index, next step)
+        # where next step is (direction, block index), or None when already on the goal
+        remaining = set(self.sources)
+        pending = list(cells)
+        result = {}
+        nearest = set()
+        for i in range(self.MAX_ROUNDS):
+            if not pending or not remaining:
+                break
+            field = self.field(remaining)
+            ranked = sorted((field.distance(index), cell_id, index) for cell_id, index in pending
+                            if field.distance(index) >= 0)
+            taken = set()
+            pending = []
+            for distance, cell_id, index in ranked:
+                goal = field.goal_of(index)
+                if i == 0:
+                    nearest.add(goal)
+                if goal in taken:
+                    pending.append((cell_id, index))
+                    continue
+                taken.add(goal)
+                result[cell_id] = (goal, field.next_step(index))
+            remaining -= taken
+
+        if 1 < len(cells) <= self.HUNGARIAN_MAX:
+            goals = sorted(nearest | set(goal for goal, step in result.values()))
+            if len(goals) <= 2 * self.HUNGARIAN_MAX:
+                result = self.exact(cells, goals, result)
+        return result
+
+    def exact(self, cells, goals, greedy):
+        fields = [self.field([goal]) for goal in goals]
+        column_of = {goal: column for column, goal in enumerate(goals)}
+        # dearer than every reachable pairing together, so the solver first
+        # assigns as many cells as it can and only then minimizes the walk
+        unreachable = len(cells) * len(self.map.types) + 1
+        # pad with goals nobody can reach so there are at least as many columns as rows
+        padding = [unreachable] * max(0, len(cells) - len(goals))
+        cost = []
+        for cell_id, index in cells:
+            distances = [field.distance(index) for field in fields]
+            cost.append([distance if distance >= 0 else unreachable for distance in distances] + padding)
+
+        result = {}
+        total = 0
+        for (cell_id, index), column in zip(cells, hungarian(cost)):
+            if column >= len(goals) or fields[column].distance(index) < 0:
+                continue
+            total += fields[column].distance(index)
+            result[cell_id] = (goals[column], fields[column].next_step(index))
+        greedy_total = sum(fields[column_of[greedy[cell_id][0]]].distance(index)
+                           for cell_id, index in cells if cell_id in greedy)
+        # more assigned cells first, then the shorter total walk
+        if (-len(result), total) >= (-len(greedy), greedy_total):
+            return greedy
+        return result
+
+
+def hungarian(cost):
+    # minimum cost assignment of every row to a distinct column, rows <= columns;
+    # returns the column of each row
+    rows = len(cost)
+    columns = len(cost[0])
+    infinity = float('inf')
+    u = [0] * (rows + 1)
+    v = [0] * (columns + 1)
+    match = [0] * (columns + 1)
+    way = [0] * (columns + 1)
+    for row in range(1, rows + 1):
+        match[0] = row
+        column = 0
+        min_value = [infinity] * (columns + 1)
+        used = [False] * (columns + 1)
+        while True:
+            used[column] = True
+            current = match[column]
+            delta = infinity
+            next_column = 0
+            for j in range(1, columns + 1):
+                if used[j]:
+                    continue
+                value = cost[current - 1][j - 1] - u[current] - v[j]
+                if value < min_value[j]:
+                    min_value[j] = value
+                    way[j] = column
+                if min_value[j] < delta:
+                    delta = min_value[j]
+                    next_column = j
+            for j in range(columns + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_value[j] -= delta
+            column = next_column
+            if match[column] == 0:
+                break
+        while column:
+            previous = way[column]
+            match[column] = match[previous]
+            column = previous
+    assignment = [0] * rows
+    for j in range(1, columns + 1):
+        if match[j]:
+            assignment[match[j] - 1] = j - 1
+    return assignment
+
+
+class ThreatMap():
+    # where the visible enemies can hit this turn, stamped once from their
+    # positions: blocks next to an enemy and blocks two steps away. attack_value
+    # is the expected hit of one enemy, AI.get_average_attack_value
+    def __init__(self, world, attack_value):
+        self.turn = world.turn
+        self.attack_value = attack_value
+        # block index -> [(direction towards the enemy, enemy cell)]
+        self.attackers = {}
+        # block index -> expected damage per turn from the adjacent enemies
+        self.damage = {}
+        # block index -> direction leading away from an enemy one or two steps off
+        self.near = {}
+        self.far = {}
+        self.build(world)
+
+    def build(self, world):
+        adjacent = world.map.adjacent
+        reverse = Constants.REVERSE_DIRECTIONS
+        attackers = self.attackers
+        damage = self.damage
+        attack_value = self.attack_value
+        near = self.near
+        far = self.far
+        for enemy in world.enemy_cells.values():
+            index = enemy.index
+            for direction, next_index in adjacent[index]:
+                # stepping in direction moves from the enemy to next_index, so
+                # that is the way out for a cell standing there
+                attackers.setdefault(next_index, []).append((reverse[direction], enemy))
+                damage[next_index] = damage.get(next_index, 0) + attack_value
+                near.setdefault(next_index, direction)
+                for second_direction, second_index in adjacent[next_index]:
+                    if second_index != index:
+                        far.setdefault(second_index, direction)
+
+    def attackers_of(self, index):
+        return self.attackers.get(index, ())
+
+    def turns_to_kill(self, index, energy):
+        # expected turns until the adjacent enemies together kill a cell with
+        # this energy standing on index; None when nothing can hit it
+        damage = self.damage.get(index)
+        if not damage:
+            return None
+        return ceil((energy + 1) / damage)
+
+    def flee_direction(self, index):
+        direction = self.near.get(index)
+        if direction is None:
+            direction = self.far.get(index)
+        return direction
+
+
+class DirectionOrder():
+    # seeded stand-in for random.shuffle(AI.DIRECTIONS): a fixed pool of
+    # permutations, one per block index and turn, so searches neither shuffle
+    # in their inner loop nor touch the shared random state
+    POOL = 64
+
+    def __init__(self, seed):
+        self.seed = seed
+        rnd = random.Random(seed)
+        self.permutations = []
+        for i in range(DirectionOrder.POOL):
+            directions = Constants.DIRECTIONS[:]
+            rnd.shuffle(directions)
+            self.permutations.append(tuple(directions))
+        self.offset = 0
+
+    def reset(self, turn):
+        # only the seed and the turn count, so a replay that drops turns still
+        # decides the same on the ones it plays
+        self.offset = random.Random(self.seed * 1000003 + turn).randrange(DirectionOrder.POOL)
+
+    def __call__(self, index):
+        return self.permutations[(index + self.offset) % DirectionOrder.POOL]
+
+
+class PathCache():
+    # LRU cache of (start, goal, jump) -> path, where a path is a list of
+    # (direction, block index) steps and None marks an unreachable goal
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.by_block = {}
+        self.unreachable = set()
+        self.world = None
+        self.hits = 0
+        self.misses = 0
+
+    def attach(self, world):
+        if self.world is world:
+            return
+        if self.world is not None:
+            self.world.map.remove_listener(self.on_block_change)
+            self.world.remove_occupancy_listener(self.on_occupancy_change)
+        self.clear()
+        self.world = world
+        world.map.add_listener(self.on_block_change)
+        world.add_occupancy_listener(self.on_occupancy_change)
+
+    def clear(self):
+        self.entries.clear()
+        self.by_block.clear()
+        self.unreachable.clear()
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return True, self.entries[key]
+
+    def put(self, key, start, path):
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = path
+        if path is None:
+            self.unreachable.add(key)
+        else:
+            self.link(key, start)
+            for direction, index in path:
+                self.link(key, index)
+        while len(self.entries) > self.max_size:
+            self.remove(next(iter(self.entries)))
+
+    def link(self, key, index):
+        keys = self.by_block.get(index)
+        if keys is None:
+            keys = self.by_block[index] = set()
+        keys.add(key)
+
+    def remove(self, key):
+        path = self.entries.pop(key)
+        if path is None:
+            self.unreachable.discard(key)
+            return
+        self.unlink(key, key[0])
+        for direction, index in path:
+            self.unlink(key, index)
+
+    def unlink(self, key, index):
+        keys = self.by_block.get(index)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                self.by_block.pop(index)
+
+    def invalidate_block(self, index):
+        keys = self.by_block.get(index)
+        if keys:
+            for key in list(keys):
+                self.remove(key)
+
+    def invalidate_unreachable(self):
+        for key in list(self.unreachable):
+            self.remove(key)
+
+    def on_block_change(self, index, old_type, old_height):
+        # a changed block breaks the paths through it; unreachable goals are
+        # only dropped for the jumps of the moves around it that opened
+        self.invalidate_block(index)
+        if not self.unreachable:
+            return
+        world_map = self.world.map
+        world_map.refresh_heights()
+        types = world_map.types
+        heights = world_map.heights
+        height = heights[index]
+        was_passable = Reachability.is_walkable(old_type)
+        is_passable = Reachability.is_walkable(types[index])
+        opened = []
+        for direction, next_index in world_map.adjacent[index]:
+            if not Reachability.is_walkable(types[next_index]):
+                continue
+            # a start block may be left whatever its type
+            opened.append((heights[next_index] - height, heights[next_index] - old_height))
+            if is_passable:
+                old_climb = old_height - heights[next_index] if was_passable else float('inf')
+                opened.append((height - heights[next_index], old_climb))
+        for key in list(self.unreachable):
+            jump = key[2]
+            if any(climb <= jump < old_climb for climb, old_climb in opened):
+                self.remove(key)
+
+    def on_occupancy_change(self, index, occupied):
+        if occupied:
+            self.invalidate_block(index)
+        else:
+            self.invalidate_unreachable()
@@ -0,0 +1,147 @@
+import argparse
+import json
+import mmap
+import struct
+import sys
+import time
+from threading import Lock
+from Model import Model, Constants
+from AI import AI
+from Metrics import Histogram
+
+
+class Recorder():
+    # one match per log: (timestamp, kind, length) header followed by the raw frame bytes
+    HEADER = struct.Struct('<dBI')
+    RECEIVED = 0
+    SENT = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.lock = Lock()
+
+    def record(self, kind, data):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(Recorder.HEADER.pack(time.time(), kind, len(data)))
+            self.file.write(data)
+
+    def record_received(self, frame):
+        self.record(Recorder.RECEIVED, frame)
+
+    def record_sent(self, frames):
+        self.record(Recorder.SENT, frames)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class LogReader():
+    # streams records out of a memory-mapped log without loading it whole
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        header = Recorder.HEADER
+        with open(self.path, 'rb') as file:
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty log
+                return
+            with data:
+                offset = 0
+                size = len(data)
+                while offset + header.size <= size:
+                    timestamp, kind, length = header.unpack_from(data, offset)
+                    offset += header.size
+                    if offset + length > size:
+                        break
+                    yield timestamp, kind, data[offset:offset + length]
+                    offset += length
+
+    def messages(self, kind=Recorder.RECEIVED):
+        for timestamp, record_kind, payload in self:
+            if record_kind != kind:
+                continue
+            for frame in payload.split(b'\x00'):
+                if frame:
+                    yield timestamp, json.loads(frame.decode('UTF-8'))
+
+
+class EventList(list):
+    def put(self, event):
+        self.append(event)
+
+
+class Replayer():
+    # feeds a recorded match into Model and AI without any socket
+    def __init__(self, path, client=None, paced=False):
+        self.reader = LogReader(path)
+        self.client = client or AI()
+        self.paced = paced
+        self.events = EventList()
+        self.model = Model(self.events)
+        self.turn_times = []
+        self.event_counts = []
+
+    def run(self):
+        started = time.time()
+        first_timestamp = None
+        for timestamp, message in self.reader.messages():
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            if self.paced:
+                delay = (timestamp - first_timestamp) - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            name = message[Constants.KEY_NAME]
+            if name == Constants.MESSAGE_TYPE_INIT:
+                self.model.handle_init_message(message)
+                self.client.on_init(self.model.world)
+            elif name == Constants.MESSAGE_TYPE_TURN:
+                self.model.handle_turn_message(message)
+                turn_started = time.time()
+                self.client.do_turn(self.model.world)
+                self.turn_times.append(time.time() - turn_started)
+                self.event_counts.append(len(self.events))
+                del self.events[:]
+            elif name == Constants.MESSAGE_TYPE_SHUTDOWN:
+                break
+        return self.report(time.time() - started)
+
+    def report(self, wall_time):
+        times = Histogram(None)
+        for turn_time in self.turn_times:
+            times.add(turn_time)
+        summary = times.summary()
+        return {
+            'turns': times.count,
+            'wall_time': wall_time,
+            'planning_time': times.total,
+            'turn_mean': summary['mean'],
+            'turn_p50': summary['p50'],
+            'turn_p95': summary['p95'],
+            'turn_max': times.max if times.count else None,
+            'events': sum(self.event_counts),
+            'overruns': len([t for t in self.turn_times if t > self.model.turn_timeout]),
+        }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="replay a recorded match through the AI")
+    parser.add_argument("log")
+    parser.add_argument("--paced", action="store_true", help="keep the recorded message timing")
+    parser.add_argument("--seed", type=int, help="seeded AI, the same decisions on every run")
+    args = parser.parse_args(argv)
+    print(json.dumps(Replayer(args.log, client=AI(seed=args.seed), paced=args.paced).run()))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,496 @@
+import argparse
+import json
+import random
+import selectors
+import socket
+import sys
+import time
+from collections import deque
+from Network import Network, FrameDecoder
+from Model import Model, Map, Block, Event, Constants
+from AI import AI
+from Replay import EventList
+from Metrics import Histogram
+
+
+def generate_map(width, height, seed=0, impassable=0.08, resource=0.15, mitosis=0.05, max_min_height=3):
+    rnd = random.Random(seed)
+    map_data = []
+    for y in range(height):
+        for x in range(width):
+            roll = rnd.random()
+            data = {
+                Constants.GAME_OBJECT_KEY_ID: y * width + x,
+                Constants.GAME_OBJECT_KEY_POSITION: {"x": x, "y": y},
+                Constants.BLOCK_KEY_MIN_HEIGHT: rnd.randint(0, max_min_height),
+                Constants.BLOCK_KEY_TURN: 0,
+            }
+            if roll < impassable:
+                data[Constants.BLOCK_KEY_TYPE] = Constants.BLOCK_TYPE_IMPASSABLE
+            elif roll < impassable + resource:
+                data[Constants.BLOCK_KEY_TYPE] = Constants.BLOCK_TYPE_RESOURCE
+                data[Constants.BLOCK_KEY_RESOURCE] = rnd.randint(50, 300)
+            elif roll < impassable + resource + mitosis:
+                data[Constants.BLOCK_KEY_TYPE] = Constants.BLOCK_TYPE_MITOSIS
+                data[Constants.BLOCK_KEY_JUMP_IMP] = 1
+                data[Constants.BLOCK_KEY_ATTACK_IMP] = 2
+                data[Constants.BLOCK_KEY_DEPTH_OF_FIELD_IMP] = 1
+                data[Constants.BLOCK_KEY_GAIN_RATE_IMP] = 3
+            else:
+                data[Constants.BLOCK_KEY_TYPE] = Constants.BLOCK_TYPE_NORMAL
+            map_data.append(data)
+    return map_data
+
+
+class SimCell():
+    def __init__(self, id1, team, index, energy=60, depth_of_field=2, jump=2, gain_rate=10, attack_value=20):
+        self.id = id1
+        self.team = team
+        self.index = index
+        self.energy = energy
+        self.depth_of_field = depth_of_field
+        self.jump = jump
+        self.gain_rate = gain_rate
+        self.attack_value = attack_value
+
+    def snapshot(self):
+        return (self.index, self.energy, self.depth_of_field, self.jump, self.gain_rate, self.attack_value)
+
+    def to_data(self, world_map):
+        return {
+            Constants.GAME_OBJECT_KEY_ID: self.id,
+            Constants.GAME_OBJECT_KEY_TEAM_ID: self.team,
+            Constants.GAME_OBJECT_KEY_TYPE: Constants.GAME_OBJECT_TYPE_CELL,
+            Constants.GAME_OBJECT_KEY_POSITION: world_map.block_at(self.index).pos,
+            Constants.CELL_KEY_ENERGY: self.energy,
+            Constants.CELL_KEY_DEPTH_OF_FIELD: self.depth_of_field,
+            Constants.CELL_KEY_JUMP: self.jump,
+            Constants.CELL_KEY_GAIN_RATE: self.gain_rate,
+            Constants.CELL_KEY_ATTACK: self.attack_value,
+        }
+
+
+class Game():
+    # simplified game rules: fog of war by depth of field, legal moves by
+    # height and jump, gain/mitosis/attack applied at the end of each turn
+    BLOCK_COEFFICIENT = 50
+    TEAM_IDS = [1, 2]
+
+    def __init__(self, width, height, cells_per_team=10, seed=0, max_turns=500,
+                 impassable=0.08, resource=0.15, mitosis=0.05):
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.max_turns = max_turns
+        self.turn = 0
+        self.map_data = generate_map(width, height, seed, impassable, resource, mitosis)
+        Block.block_coefficient = Game.BLOCK_COEFFICIENT
+        self.map = Map({Constants.MAP_SIZE_WIDTH: width, Constants.MAP_SIZE_HEIGHT: height}, self.map_data)
+        self.cells = {}
+        self.cells_by_index = {}
+        self.next_cell_id = 1000000
+        self.events = {team: [] for team in Game.TEAM_IDS}
+        self.changed_blocks = set()
+        self.destroyed = []
+        self.revealed = {team: set() for team in Game.TEAM_IDS}
+        self.known_cells = {team: {} for team in Game.TEAM_IDS}
+        for team in Game.TEAM_IDS:
+            for i in range(cells_per_team):
+                self.spawn(team, self.random_free_index())
+
+    def random_free_index(self):
+        while True:
+            index = self.random.randrange(self.width * self.height)
+            if self.is_walkable(index) and index not in self.cells_by_index:
+                return index
+
+    def is_walkable(self, index):
+        block_type = self.map.types[index]
+        return block_type != 0 and block_type != Block.IMPASSABLE_CODE
+
+    def spawn(self, team, index, **stats):
+        cell = SimCell(self.next_cell_id, team, index, **stats)
+        self.next_cell_id += 1
+        self.cells[cell.id] = cell
+        self.cells_by_index[index] = cell
+        return cell
+
+    def remove(self, cell):
+        self.cells.pop(cell.id)
+        self.cells_by_index.pop(cell.index)
+        self.destroyed.append(cell.id)
+
+    def team_info(self, team):
+        return {
+            Constants.INFO_KEY_TEAMS: [{Constants.KEY_NAME: "team" + str(t), Constants.KEY_ID: t}
+                                       for t in Game.TEAM_IDS],
+            Constants.INFO_KEY_YOUR_INFO: {Constants.KEY_NAME: "team" + str(team), Constants.KEY_ID: team},
+            Constants.INFO_KEY_MAP_SIZE: {Constants.MAP_SIZE_WIDTH: self.width,
+                                          Constants.MAP_SIZE_HEIGHT: self.height},
+            Constants.INFO_KEY_BLOCK_COEFFICIENT: Game.BLOCK_COEFFICIENT,
+            Constants.KEY_TURN: self.turn,
+        }
+
+    def init_message(self, team):
+        # unseen blocks are sent as type "n" and revealed through statics
+        map_data = [{
+            Constants.GAME_OBJECT_KEY_ID: data[Constants.GAME_OBJECT_KEY_ID],
+            Constants.GAME_OBJECT_KEY_POSITION: data[Constants.GAME_OBJECT_KEY_POSITION],
+            Constants.BLOCK_KEY_TYPE: Constants.BLOCK_TYPE_NONE,
+        } for data in self.map_data]
+        return {Constants.KEY_NAME: Constants.MESSAGE_TYPE_INIT, Constants.KEY_ARGS: [self.team_info(team), map_data]}
+
+    def block_data(self, index):
+        block = self.map.block_at(index)
+        data = {
+            Constants.GAME_OBJECT_KEY_ID: block.id,
+            Constants.GAME_OBJECT_KEY_POSITION: block.pos,
+            Constants.BLOCK_KEY_TYPE: block.type,
+            Constants.BLOCK_KEY_MIN_HEIGHT: block.min_height,
+            Constants.BLOCK_KEY_TURN: self.turn,
+        }
+        if block.type == Constants.BLOCK_TYPE_RESOURCE:
+            data[Constants.BLOCK_KEY_RESOURCE] = block.resource
+        elif block.type == Constants.BLOCK_TYPE_MITOSIS:
+            data[Constants.BLOCK_KEY_JUMP_IMP] = block.jump_improvement_amount
+            data[Constants.BLOCK_KEY_ATTACK_IMP] = block.attack_improvement_amount
+            data[Constants.BLOCK_KEY_DEPTH_OF_FIELD_IMP] = block.depth_of_field_improvement_amount
+            data[Constants.BLOCK_KEY_GAIN_RATE_IMP] = block.gain_improvement_amount
+        return data
+
+    def visible_blocks(self, team):
+        visible = set()
+        for cell in self.cells.values():
+            if cell.team != team:
+                continue
+            frontier = [cell.index]
+            visible.add(cell.index)
+            for step in range(cell.depth_of_field):
+                next_frontier = []
+                for index in frontier:
+                    for direction, next_index in self.map.neighbors_of(index):
+                        if next_index not in visible:
+                            visible.add(next_index)
+                            next_frontier.append(next_index)
+                frontier = next_frontier
+        return visible
+
+    def turn_message(self, team):
+        visible = self.visible_blocks(team)
+        revealed = self.revealed[team]
+        statics = [self.block_data(index) for index in visible - revealed]
+        statics += [self.block_data(index) for index in self.changed_blocks & revealed]
+        revealed |= visible
+
+        dynamics = []
+        known = self.known_cells[team]
+        for cell_id in self.destroyed:
+            if known.pop(cell_id, None) is not None:
+                dynamics.append({Constants.GAME_OBJECT_KEY_ID: cell_id,
+                                 Constants.GAME_OBJECT_KEY_TYPE: Constants.GAME_OBJECT_TYPE_DESTROYED})
+        for cell in self.cells.values():
+            state = known.get(cell.id)
+            if cell.team == team or cell.index in visible:
+                if state is None:
+                    dynamics.append(cell.to_data(self.map))
+                elif not state[0]:
+                    data = cell.to_data(self.map)
+                    data[Constants.CELL_KEY_VISIBLE] = 1
+                    dynamics.append(data)
+                elif state[1] != cell.snapshot():
+                    dynamics.append(cell.to_data(self.map))
+                known[cell.id] = (True, cell.snapshot())
+            elif state is not None and state[0]:
+                dynamics.append({Constants.GAME_OBJECT_KEY_ID: cell.id, Constants.CELL_KEY_VISIBLE: 0})
+                known[cell.id] = (False, state[1])
+
+        return {Constants.KEY_NAME: Constants.MESSAGE_TYPE_TURN,
+                Constants.KEY_ARGS: [self.turn, {Constants.KEY_STATICS: statics,
+                                                 Constants.KEY_DYNAMICS: dynamics}]}
+
+    def add_event(self, team, event):
+        self.events[team].append(event)
+
+    def step(self):
+        self.changed_blocks = set()
+        self.destroyed = []
+        acted = set()
+        pending = []
+        for team in Game.TEAM_IDS:
+            pending += self.events[team]
+            self.events[team] = []
+        # attacks resolve before anything moves
+        pending.sort(key=lambda event: event.get(Constants.KEY_TYPE) != Event.TYPE_ATTACK)
+        for event in pending:
+            cell = self.cells.get(event.get(Constants.GAME_OBJECT_KEY_OBJECT_ID))
+            if cell is None or cell.id in acted or cell.team != event.get(Constants.KEY_TEAM_ID):
+                continue
+            acted.add(cell.id)
+            self.apply(cell, event)
+        self.turn += 1
+
+    def apply(self, cell, event):
+        event_type = event.get(Constants.KEY_TYPE)
+        args = event.get(Constants.KEY_ARGS) or []
+        if event_type == Event.TYPE_MOVE and args:
+            next_index = self.target_index(cell, args[0])
+            if next_index is not None and self.is_walkable(next_index) \
+                    and next_index not in self.cells_by_index \
+                    and self.map.heights[next_index] - self.map.heights[cell.index] <= cell.jump:
+                self.cells_by_index.pop(cell.index)
+                cell.index = next_index
+                self.cells_by_index[next_index] = cell
+        elif event_type == Event.TYPE_ATTACK and args:
+            next_index = self.target_index(cell, args[0])
+            enemy = self.cells_by_index.get(next_index)
+            if enemy is not None and enemy.team != cell.team:
+                enemy.energy -= cell.attack_value
+                if enemy.energy <= 0:
+                    self.remove(enemy)
+        elif event_type == Event.TYPE_GAIN_RESOURCE:
+            resource = self.map.resources[cell.index]
+            amount = int(min(cell.gain_rate, resource, Constants.CELL_MAX_ENERGY - cell.energy))
+            if amount > 0:
+                cell.energy += amount
+                self.map.set_block_change(cell.index, {Constants.BLOCK_KEY_RESOURCE: resource - amount})
+                self.map.refresh_heights()
+                self.changed_blocks.add(cell.index)
+        elif event_type == Event.TYPE_MITOSIS:
+            if self.map.types[cell.index] != Block.MITOSIS_CODE \
+                    or cell.energy < Constants.CELL_MIN_ENERGY_FOR_MITOSIS:
+                return
+            for direction, next_index in self.map.neighbors_of(cell.index):
+                if self.is_walkable(next_index) and next_index not in self.cells_by_index:
+                    block = self.map.block_at(cell.index)
+                    cell.energy //= 2
+                    cell.jump = min(Constants.CELL_MAX_JUMP, cell.jump + block.jump_improvement_amount)
+                    cell.attack_value = min(Constants.CELL_MAX_ATTACK,
+                                            cell.attack_value + block.attack_improvement_amount)
+                    cell.depth_of_field = min(Constants.CELL_MAX_DEPTH_OF_FIELD,
+                                              cell.depth_of_field + block.depth_of_field_improvement_amount)
+                    cell.gain_rate = min(Constants.CELL_MAX_GAIN_RATE, cell.gain_rate + block.gain_improvement_amount)
+                    self.spawn(cell.team, next_index, energy=cell.energy, depth_of_field=cell.depth_of_field,
+                               jump=cell.jump, gain_rate=cell.gain_rate, attack_value=cell.attack_value)
+                    return
+
+    def target_index(self, cell, direction):
+        if direction not in self.map.neighbors:
+            return None
+        next_index = self.map.next_index(direction, cell.index)
+        return next_index if next_index >= 0 else None
+
+    def team_cells(self, team):
+        return [cell for cell in self.cells.values() if cell.team == team]
+
+    def is_finished(self):
+        if self.turn >= self.max_turns:
+            return True
+        return any(not self.team_cells(team) for team in Game.TEAM_IDS)
+
+    def scores(self):
+        return {team: sum(cell.energy for cell in self.team_cells(team)) for team in Game.TEAM_IDS}
+
+    def winner(self):
+        scores = self.scores()
+        best = max(scores.values())
+        leaders = [team for team, score in scores.items() if score == best]
+        return leaders[0] if len(leaders) == 1 else None
+
+
+class LocalTeam():
+    # an AI playing in-process: same Model/AI code, no sockets
+    def __init__(self, game, team, client=None):
+        self.game = game
+        self.team = team
+        self.events = EventList()
+        self.model = Model(self.events)
+        self.client = client or AI()
+        self.model.handle_init_message(game.init_message(team))
+        self.client.on_init(self.model.world)
+
+    def play(self, message):
+        self.model.handle_turn_message(message)
+        self.client.do_turn(self.model.world)
+        for event in self.events:
+            self.game.add_event(self.team, event)
+        del self.events[:]
+
+
+class RandomTeam():
+    def __init__(self, game, team):
+        self.game = game
+        self.team = team
+
+    def play(self, message):
+        game = self.game
+        for cell in game.team_cells(self.team):
+            if game.map.resources[cell.index] > 0 and cell.energy < Constants.CELL_MAX_ENERGY:
+                event = Event(Event.TYPE_GAIN_RESOURCE, cell.id, self.team)
+            else:
+                event = Event(Event.TYPE_MOVE, cell.id, self.team)
+                event.add_arg(game.random.choice(Constants.DIRECTIONS))
+            game.add_event(self.team, event.to_message())
+
+
+class Server():
+    def __init__(self, game, port, token, clients=1, turn_timeout=0.4, opponent="random"):
+        self.game = game
+        self.port = port
+        self.token = token
+        self.clients = clients
+        self.turn_timeout = turn_timeout
+        self.opponent = opponent
+        self.connections = {}
+        self.local_teams = []
+        self.selector = selectors.DefaultSelector()
+        self.stats = []
+
+    def accept_clients(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("", self.port))
+        listener.listen(self.clients)
+        print("waiting for {} client(s) on port {}".format(self.clients, self.port))
+        teams = deque(Game.TEAM_IDS)
+        while len(self.connections) < self.clients:
+            conn, address = listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            decoder = FrameDecoder()
+            frames = deque()
+            while not frames:
+                data = conn.recv(Network.RECV_SIZE)
+                if not data:
+                    break
+                decoder.feed(data, frames)
+            if not frames or frames[0].get(Constants.KEY_ARGS) != [self.token]:
+                conn.sendall(Network.encode_frames([{Constants.KEY_NAME: "wrong token", Constants.KEY_ARGS: []}]))
+                conn.close()
+                continue
+            team = teams.popleft()
+            conn.setblocking(False)
+            self.connections[team] = (conn, decoder)
+            self.selector.register(conn, selectors.EVENT_READ, team)
+            conn.sendall(Network.encode_frames([self.game.init_message(team)]))
+            print("client {} joined as team {}".format(address, team))
+        listener.close()
+        for team in teams:
+            if self.opponent == "ai":
+                self.local_teams.append(LocalTeam(self.game, team))
+            else:
+                self.local_teams.append(RandomTeam(self.game, team))
+
+    def run(self):
+        self.accept_clients()
+        while not self.game.is_finished():
+            self.play_turn()
+        shutdown = Network.encode_frames([{Constants.KEY_NAME: Constants.MESSAGE_TYPE_SHUTDOWN, Constants.KEY_ARGS: []}])
+        for conn, decoder in self.connections.values():
+            try:
+                conn.setblocking(True)
+                conn.sendall(shutdown)
+                conn.close()
+            except OSError:
+                pass
+        return self.report()
+
+    def play_turn(self):
+        game = self.game
+        alive = {team: len(game.team_cells(team)) for team in self.connections}
+        for team, (conn, decoder) in self.connections.items():
+            conn.setblocking(True)
+            conn.sendall(Network.encode_frames([game.turn_message(team)]))
+            conn.setblocking(False)
+        sent_at = time.time()
+        for local in self.local_teams:
+            local.play(game.turn_message(local.team))
+
+        acted = {team: set() for team in self.connections}
+        last_event = {team: None for team in self.connections}
+        deadline = sent_at + self.turn_timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for key, mask in self.selector.select(remaining):
+                team = key.data
+                conn, decoder = self.connections[team]
+                try:
+                    data = conn.recv(Network.RECV_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    self.selector.unregister(conn)
+                    continue
+                frames = []
+                decoder.feed(data, frames)
+                for frame in frames:
+                    if frame.get(Constants.KEY_NAME) != Constants.MESSAGE_TYPE_EVENT:
+                        continue
+                    for event in frame.get(Constants.KEY_ARGS, []):
+                        event[Constants.KEY_TEAM_ID] = team
+                        game.add_event(team, event)
+                        acted[team].add(event.get(Constants.GAME_OBJECT_KEY_OBJECT_ID))
+                        last_event[team] = time.time() - sent_at
+
+        for team in self.connections:
+            self.stats.append({
+                'turn': game.turn,
+                'team': team,
+                'cells': alive[team],
+                'acted': len(acted[team]),
+                'last_event': last_event[team],
+            })
+        game.step()
+
+    def report(self):
+        latencies = Histogram(None)
+        for stat in self.stats:
+            if stat['last_event'] is not None:
+                latencies.add(stat['last_event'])
+        missed = [stat for stat in self.stats if stat['acted'] < stat['cells']]
+        return {
+            'width': self.game.width,
+            'height': self.game.height,
+            'turns': self.game.turn,
+            'turn_timeout': self.turn_timeout,
+            'turns_with_missing_actions': len(missed),
+            'last_event_p50': latencies.percentile(0.5),
+            'last_event_p95': latencies.percentile(0.95),
+            'last_event_max': latencies.max if latencies.count else None,
+            'scores': self.game.scores(),
+            'per_turn': self.stats,
+        }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="local stand-in game server")
+    parser.add_argument("--settings", default="connection.conf")
+    parser.add_argument("--width", type=int, default=40)
+    parser.add_argument("--height", type=int, default=40)
+    parser.add_argument("--cells", type=int, default=10, help="cells per team at start")
+    parser.add_argument("--impassable", type=float, default=0.08)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=0.4)
+    parser.add_argument("--clients", type=int, default=1, choices=[1, 2])
+    parser.add_argument("--opponent", default="random", choices=["random", "ai"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", help="write the timing report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    with open(args.settings) as file:
+        conf = json.loads(file.read())
+    game = Game(args.width, args.height, cells_per_team=args.cells, seed=args.seed,
+                max_turns=args.turns, impassable=args.impassable)
+    server = Server(game, conf[Constants.CONFIG_KEY_PORT], conf[Constants.CONFIG_KEY_TOKEN],
+                    clients=args.clients, turn_timeout=args.timeout, opponent=args.opponent)
+    report = server.run()
+    summary = {key: value for key, value in report.items() if key != 'per_turn'}
+    print(json.dumps(summary))
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(report, file)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,259 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import random
+import sys
+import time
+from AI import AI
+from Model import Constants
+from Server import Game, LocalTeam, RandomTeam
+from Metrics import Histogram
+
+
+OWNERS = {'AI': AI, 'Constants': Constants}
+
+
+class Overrides():
+    # "AI.NAME" / "Constants.NAME" parameters are class attributes swapped in
+    # only while their team plays; plain names are AI constructor arguments
+    def __init__(self, params):
+        self.attributes = []
+        self.options = {}
+        self.saved = []
+        for name, value in params.items():
+            owner, dot, attribute = name.rpartition('.')
+            if not owner:
+                self.options[name] = value
+            elif owner in OWNERS and hasattr(OWNERS[owner], attribute):
+                self.attributes.append((OWNERS[owner], attribute, value))
+            else:
+                raise ValueError("unknown parameter " + name)
+
+    def __enter__(self):
+        self.saved = [(owner, attribute, getattr(owner, attribute)) for owner, attribute, value in self.attributes]
+        for owner, attribute, value in self.attributes:
+            setattr(owner, attribute, value)
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, attribute, value in self.saved:
+            setattr(owner, attribute, value)
+        self.saved = []
+
+
+class Player():
+    def __init__(self, game, team, params, max_turns):
+        self.team = team
+        self.timings = Histogram(max_turns)
+        if params == "random":
+            self.overrides = Overrides({})
+            self.client = RandomTeam(game, team)
+        else:
+            self.overrides = Overrides(params)
+            with self.overrides:
+                self.client = LocalTeam(game, team, AI(**self.overrides.options))
+
+    def play(self, message):
+        with self.overrides:
+            started = time.perf_counter()
+            self.client.play(message)
+            self.timings.add(time.perf_counter() - started)
+
+    def close(self):
+        if isinstance(self.client, LocalTeam):
+            self.client.client.close()
+
+
+def play_match(match):
+    # one whole game in this process; match and result are plain dicts for the pool
+    random.seed(match['seed'])
+    game = Game(match['width'], match['height'], cells_per_team=match['cells'], seed=match['seed'],
+                max_turns=match['turns'], impassable=match['impassable'])
+    players = [Player(game, team, params, match['turns']) for team, params in zip(Game.TEAM_IDS, match['teams'])]
+    started = time.time()
+    try:
+        while not game.is_finished():
+            for player in players:
+                player.play(game.turn_message(player.team))
+            game.step()
+    finally:
+        for player in players:
+            player.close()
+    return {
+        'config': match['config'],
+        'side': match['side'],
+        'seed': match['seed'],
+        'winner': game.winner(),
+        'turns': game.turn,
+        'scores': game.scores(),
+        'wall_time': time.time() - started,
+        'timings': {player.team: player.timings.summary() for player in players},
+    }
+
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parse_assignments(items):
+    params = {}
+    for item in items or []:
+        name, equals, value = item.partition("=")
+        params[name] = parse_value(value)
+    return params
+
+
+def grid_configs(grid):
+    # grid: name -> list of values; every combination
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def random_configs(ranges, samples, seed):
+    # ranges: name -> (low, high); integers stay integers
+    rnd = random.Random(seed)
+    configs = []
+    for i in range(samples):
+        config = {}
+        for name, (low, high) in sorted(ranges.items()):
+            if isinstance(low, int) and isinstance(high, int):
+                config[name] = rnd.randint(low, high)
+            else:
+                config[name] = rnd.uniform(low, high)
+        configs.append(config)
+    return configs
+
+
+def build_matches(configs, fixed, baseline, games, seed, width, height, cells, turns, impassable):
+    # each pair of games shares a seed with the candidate on either side
+    matches = []
+    for number, config in enumerate(configs):
+        candidate = dict(fixed, **config)
+        for game in range(games):
+            side = game % 2
+            teams = [candidate, baseline] if side == 0 else [baseline, candidate]
+            matches.append({
+                'config': number, 'side': side, 'seed': seed + game // 2, 'teams': teams,
+                'width': width, 'height': height, 'cells': cells, 'turns': turns, 'impassable': impassable,
+            })
+    return matches
+
+
+def summarize(configs, results):
+    summary = []
+    for number, config in enumerate(configs):
+        wins = losses = draws = 0
+        score_diff = 0
+        turn_count = 0
+        turn_total = 0.0
+        turn_max = 0.0
+        turn_p95 = 0.0
+        for result in results:
+            if result['config'] != number:
+                continue
+            me = Game.TEAM_IDS[result['side']]
+            other = Game.TEAM_IDS[1 - result['side']]
+            if result['winner'] is None:
+                draws += 1
+            elif result['winner'] == me:
+                wins += 1
+            else:
+                losses += 1
+            score_diff += result['scores'][me] - result['scores'][other]
+            timing = result['timings'][me]
+            if timing['count']:
+                turn_count += timing['count']
+                turn_total += timing['mean'] * timing['count']
+                turn_max = max(turn_max, timing['max'])
+                turn_p95 = max(turn_p95, timing['p95'])
+        games = wins + losses + draws
+        summary.append({
+            'config': config,
+            'games': games,
+            'wins': wins,
+            'losses': losses,
+            'draws': draws,
+            'win_rate': (wins + 0.5 * draws) / games if games else None,
+            'mean_score_diff': score_diff / games if games else None,
+            'turn_mean': turn_total / turn_count if turn_count else None,
+            'turn_worst_p95': turn_p95,
+            'turn_max': turn_max,
+        })
+    summary.sort(key=lambda item: -(item['win_rate'] or 0))
+    return summary
+
+
+def run(matches, workers):
+    results = []
+    # results keep coming as matches finish, so progress shows overnight runs
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(play_match, matches):
+            results.append(result)
+            print("{}/{} config={} winner={} turns={}".format(
+                len(results), len(matches), result['config'], result['winner'], result['turns']), file=sys.stderr)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="self-play tournaments and parameter sweeps")
+    parser.add_argument("--grid", action="append", metavar="NAME=V1,V2,...",
+                        help="sweep every combination, e.g. AI.ATTACK_WIN_THRESHOLD=-2,-1,0")
+    parser.add_argument("--range", action="append", metavar="NAME=LOW:HIGH",
+                        help="sample uniformly, see --samples")
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE",
+                        help="fixed for every candidate, e.g. use_astar=true")
+    parser.add_argument("--baseline", action="append", metavar="NAME=VALUE",
+                        help="opponent parameters, default is the AI as shipped")
+    parser.add_argument("--opponent", default="ai", choices=["ai", "random"])
+    parser.add_argument("--games", type=int, default=10, help="games per configuration")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--width", type=int, default=40)
+    parser.add_argument("--height", type=int, default=40)
+    parser.add_argument("--cells", type=int, default=10, help="cells per team at start")
+    parser.add_argument("--impassable", type=float, default=0.08)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the summary and every match result as JSON to this file")
+    args = parser.parse_args(argv)
+
+    configs = [{}]
+    if args.grid:
+        grid = {}
+        for item in args.grid:
+            name, equals, values = item.partition("=")
+            grid[name] = [parse_value(value) for value in values.split(",")]
+        configs = grid_configs(grid)
+    if args.range:
+        ranges = {}
+        for item in args.range:
+            name, equals, bounds = item.partition("=")
+            low, colon, high = bounds.partition(":")
+            ranges[name] = (parse_value(low), parse_value(high))
+        configs = [dict(a, **b) for a in configs for b in random_configs(ranges, args.samples, args.seed)]
+
+    fixed = parse_assignments(args.set)
+    baseline = "random" if args.opponent == "random" else parse_assignments(args.baseline)
+    for params in configs + [fixed] + ([] if baseline == "random" else [baseline]):
+        try:
+            Overrides(params)
+        except ValueError as e:
+            parser.error(str(e))
+    matches = build_matches(configs, fixed, baseline, args.games, args.seed, args.width, args.height,
+                            args.cells, args.turns, args.impassable)
+    started = time.time()
+    results = run(matches, args.workers)
+    report = {'wall_time': time.time() - started, 'summary': summarize(configs, results)}
+    print(json.dumps(report['summary'], indent=1))
+    if args.output:
+        report['matches'] = results
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,120 @@
+import random
+import unittest
+from AI import AI
+from Model import Model, Constants
+from Replay import EventList
+from Server import Game
+
+
+class RecordingAI(AI):
+    # the order cells reach goal planning and the fallback
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.handled = []
+
+    def plan_goal(self, world, cell):
+        self.handled.append(('goal', cell.id))
+        super().plan_goal(world, cell)
+
+    def fallback_move(self, world, cell):
+        self.handled.append(('fallback', cell.id))
+        super().fallback_move(world, cell)
+
+
+def make_model(game):
+    # a client of team 1 that sees the whole map and every cell
+    model = Model(EventList())
+    model.handle_init_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_INIT,
+                               Constants.KEY_ARGS: [game.team_info(Game.TEAM_IDS[0]), game.map_data]})
+    dynamics = [cell.to_data(game.map) for cell in game.cells.values()]
+    model.handle_turn_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_TURN,
+                               Constants.KEY_ARGS: [1, {Constants.KEY_STATICS: [],
+                                                        Constants.KEY_DYNAMICS: dynamics}]})
+    return model
+
+
+class BudgetedTurnTest(unittest.TestCase):
+    def test_deadline_partway_through_a_turn(self):
+        random.seed(0)
+        game = Game(30, 30, cells_per_team=0, seed=3)
+        team, enemy = Game.TEAM_IDS
+        attackers = []
+        for i in range(2):
+            index = game.random_free_index()
+            attackers.append(game.spawn(team, index).id)
+            direction, next_index = next((direction, next_index) for direction, next_index
+                                         in game.map.neighbors_of(index) if game.is_walkable(next_index)
+                                         and next_index not in game.cells_by_index)
+            game.spawn(enemy, next_index, energy=5)
+        energies = [90] * 4 + [30] * 6 + [100] * 4
+        random.Random(1).shuffle(energies)
+        for energy in energies:
+            game.spawn(team, game.random_free_index(), energy=energy)
+        model = make_model(game)
+        world = model.world
+        ai = RecordingAI(budgeted=True, seed=1)
+        # the full-energy cells explored last turn
+        ai.exploring = {cell.id for cell in world.my_cells.values() if cell.energy == 100}
+
+        calls = []
+
+        def remaining_time():
+            # plenty for the first four goal searches, then past the safety margin
+            calls.append(1)
+            return 1.0 if len(calls) <= 4 else 0.0
+
+        model.turn_remaining_time = remaining_time
+        ai.do_turn(world)
+
+        acted = [event[Constants.GAME_OBJECT_KEY_OBJECT_ID] for event in model.queue]
+        handled = [cell_id for step, cell_id in ai.handled]
+        urgent = [cell_id for cell_id in acted if cell_id not in handled]
+        self.assertTrue(set(attackers) <= set(urgent))
+        # every cell is handled once: urgent actions first, then by priority
+        self.assertEqual(len(acted), len(set(acted)))
+        self.assertEqual(sorted(urgent + handled), sorted(world.my_cells))
+        self.assertEqual(acted, urgent + [cell_id for cell_id in handled if cell_id in acted])
+        # goal tiers in priority order, and nothing searched after the deadline
+        tiers = [ai.goal_priority(world.my_cells[cell_id]) for cell_id in handled]
+        self.assertEqual(tiers, sorted(tiers))
+        self.assertEqual(set(tiers), {0, 1, 2})
+        steps = [step for step, cell_id in ai.handled]
+        self.assertEqual(steps, ['goal'] * 4 + ['fallback'] * (len(steps) - 4))
+        self.assertGreater(len(steps), 4)
+        # and every cell past the deadline still moves
+        fallbacks = [cell_id for step, cell_id in ai.handled if step == 'fallback']
+        self.assertTrue(set(fallbacks) <= set(acted))
+
+
+class FollowPlanTest(unittest.TestCase):
+    def test_conflicting_worker_plans(self):
+        game = Game(20, 20, cells_per_team=0, seed=2)
+        team = Game.TEAM_IDS[0]
+        cells = [game.spawn(team, game.random_free_index(), energy=30).id for i in range(4)]
+        model = make_model(game)
+        world = model.world
+        ai = RecordingAI(seed=1)
+        ai.on_init(world)
+        first, second, third, fourth = (world.my_cells[cell_id] for cell_id in cells)
+        north, south = Constants.Directions.NORTH, Constants.Directions.SOUTH
+        north_east, north_west = Constants.Directions.NORTH_EAST, Constants.Directions.NORTH_WEST
+        # goal blocks are only compared, never looked up
+        ai.follow_plan(world, first, ([(1, north, 11, True), (2, north, 11, True)], False, None, False))
+        ai.follow_plan(world, second, ([(1, south, 12, True), (3, north_east, 13, True)], False, None, False))
+        # every candidate taken, but there were more than the worker sent
+        ai.follow_plan(world, third, ([(1, south, 12, True), (3, north_east, 13, True)], True, None, False))
+        # every candidate taken and no more: explore where the worker found
+        ai.follow_plan(world, fourth, ([(3, north, 11, True)], False, [(4, north_west, 14, True)], False))
+
+        moves = {event[Constants.GAME_OBJECT_KEY_OBJECT_ID]: event[Constants.KEY_ARGS][0] for event in model.queue}
+        self.assertEqual(moves[first.id], north)
+        self.assertEqual(moves[second.id], north_east)
+        self.assertEqual(moves[fourth.id], north_west)
+        self.assertEqual(ai.handled, [('goal', third.id)])
+        self.assertTrue({1, 3, 4} <= ai.targets)
+        self.assertIn(fourth.id, ai.exploring)
+        self.assertNotIn(first.id, ai.exploring)
+
+
+if __name__ == "__main__":
+    unittest.main()
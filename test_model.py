@@ -0,0 +1,90 @@
+import random
+import unittest
+from types import SimpleNamespace
+from Model import Model, Map, Block, Constants, LastSeen
+from Replay import EventList
+from Server import Game
+
+
+class NeighborTableTest(unittest.TestCase):
+    def test_matches_get_next_pos(self):
+        for width, height in ((1, 1), (1, 4), (3, 1), (2, 3), (7, 5), (8, 9)):
+            world_map = Map({Constants.MAP_SIZE_WIDTH: width, Constants.MAP_SIZE_HEIGHT: height}, [])
+            for index in range(width * height):
+                expected = []
+                for direction in Constants.DIRECTIONS:
+                    pos = world_map.get_next_pos(direction, world_map.pos_of(index))
+                    if 0 <= pos["x"] < width and 0 <= pos["y"] < height:
+                        next_index = world_map.index_of(pos)
+                        expected.append((direction, next_index))
+                    else:
+                        next_index = Map.NO_NEIGHBOR
+                    self.assertEqual(world_map.next_index(direction, index), next_index)
+                self.assertEqual(world_map.neighbors_of(index), tuple(expected))
+
+
+class LoadTest(unittest.TestCase):
+    def test_heights_match_refresh_heights(self):
+        game = Game(30, 20, cells_per_team=0, seed=5)
+        world_map = Map({Constants.MAP_SIZE_WIDTH: 30, Constants.MAP_SIZE_HEIGHT: 20}, game.map_data)
+        loaded = list(world_map.heights)
+        world_map.dirty.update(world_map.ids.values())
+        world_map.refresh_heights()
+        self.assertEqual(loaded, list(world_map.heights))
+        self.assertTrue(any(world_map.types[index] == Block.RESOURCE_CODE and height != int(height)
+                            for index, height in enumerate(loaded)))
+
+
+class LastSeenTest(unittest.TestCase):
+    def test_near_matches_brute_force(self):
+        rnd = random.Random(0)
+        world_map = Map({Constants.MAP_SIZE_WIDTH: 40, Constants.MAP_SIZE_HEIGHT: 30}, [])
+        last_seen = LastSeen(world_map, 100, 1000)
+        for cell_id in range(200):
+            last_seen.record(SimpleNamespace(id=cell_id, team_id=2, index=rnd.randrange(40 * 30), energy=10),
+                             rnd.randint(0, 20))
+        for cell_id in range(0, 200, 3):
+            last_seen.remove(cell_id)
+        for i in range(50):
+            index = rnd.randrange(40 * 30)
+            radius = rnd.randint(0, 12)
+            max_age = rnd.choice([None, 5])
+            expected = sorted(sighting.cell_id for sighting in last_seen.sightings.values()
+                              if Map.hex_distance(40, index, sighting.index) <= radius
+                              and (max_age is None or 20 - sighting.turn <= max_age))
+            found = last_seen.near(index, radius, turn=20, max_age=max_age)
+            self.assertEqual(sorted(sighting.cell_id for sighting in found), expected)
+
+    def test_forgotten_cells_leave_nothing_behind(self):
+        game = Game(20, 20, cells_per_team=0, seed=1)
+        team, enemy = Game.TEAM_IDS
+        enemies = [game.spawn(enemy, game.random_free_index()) for i in range(30)]
+        model = Model(EventList(), fog_horizon=3, fog_max_cells=10)
+        model.handle_init_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_INIT,
+                                   Constants.KEY_ARGS: [game.team_info(team), game.map_data]})
+        world = model.world
+
+        def turn(number, dynamics):
+            model.handle_turn_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_TURN,
+                                       Constants.KEY_ARGS: [number, {Constants.KEY_STATICS: [],
+                                                                     Constants.KEY_DYNAMICS: dynamics}]})
+
+        turn(1, [cell.to_data(game.map) for cell in enemies])
+        for number in range(2, 12):
+            # a few enemies go out of sight every turn and are never seen again
+            turn(number, [{Constants.GAME_OBJECT_KEY_ID: cell.id, Constants.CELL_KEY_VISIBLE: 0}
+                          for cell in enemies[(number - 2) * 3:(number - 1) * 3]])
+            self.assertLessEqual(len(world.last_seen), 10)
+        turn(20, [])
+        self.assertEqual(len(world.last_seen), 0)
+        self.assertEqual(world.last_seen.buckets, {})
+        self.assertEqual(len(world.all_visited_cells), 0)
+        # seen again through a partial update: the only other team is the enemy
+        data = enemies[0].to_data(game.map)
+        data.pop(Constants.GAME_OBJECT_KEY_TEAM_ID)
+        turn(21, [data])
+        self.assertEqual(world.enemy_cells[enemies[0].id].team_id, enemy)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,276 @@
+import io
+import itertools
+import random
+import unittest
+from contextlib import redirect_stderr
+from types import SimpleNamespace
+from AI import AI
+from Model import Model, Constants
+from ParallelPlanner import ParallelPlanner
+from Planner import Components, DistanceField, PathCache, PathSearch, Reachability, TargetAssignment, hungarian
+from Replay import EventList
+from Server import Game
+
+
+def make_model(size, seed, impassable=0.15):
+    game = Game(size, size, cells_per_team=0, seed=seed, impassable=impassable)
+    # the whole map, as the server knows it, and no cells
+    model = Model(EventList())
+    model.handle_init_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_INIT,
+                               Constants.KEY_ARGS: [game.team_info(Game.TEAM_IDS[0]), game.map_data]})
+    model.world.map.refresh_heights()
+    return model
+
+
+def make_map(size, seed, impassable=0.15):
+    return make_model(size, seed, impassable).world.map
+
+
+class HungarianTest(unittest.TestCase):
+    def test_matches_brute_force(self):
+        rnd = random.Random(0)
+        for i in range(200):
+            rows = rnd.randint(1, 5)
+            columns = rnd.randint(rows, 6)
+            cost = [[rnd.randint(0, 20) for column in range(columns)] for row in range(rows)]
+            assignment = hungarian(cost)
+            self.assertEqual(len(set(assignment)), rows)
+            best = min(sum(cost[row][column] for row, column in enumerate(columns_of))
+                       for columns_of in itertools.permutations(range(columns), rows))
+            self.assertEqual(sum(cost[row][column] for row, column in enumerate(assignment)), best)
+
+
+class DistanceFieldTest(unittest.TestCase):
+    def test_remove_source_matches_fresh_build(self):
+        rnd = random.Random(2)
+        for seed in range(3):
+            world_map = make_map(25, seed)
+            resources = list(world_map.indexes_of(Constants.BLOCK_TYPE_RESOURCE))
+            for jump in (1, 3):
+                field = DistanceField(world_map, resources, jump)
+                sources = list(resources)
+                for source in rnd.sample(resources, len(resources) // 2):
+                    sources.remove(source)
+                    field.remove_source(source)
+                    fresh = DistanceField(world_map, sources, jump)
+                    self.assertEqual(list(field.dist), list(fresh.dist))
+                    # ties may pick another goal, but every step leads to it one block closer
+                    for index, distance in enumerate(field.dist):
+                        if distance == 0:
+                            self.assertEqual(field.goal_of(index), index)
+                        elif distance > 0:
+                            self.assertIn(field.goal_of(index), sources)
+                            direction, next_index = field.next_step(index)
+                            self.assertEqual(field.distance(next_index), distance - 1)
+                            self.assertEqual(field.goal_of(next_index), field.goal_of(index))
+                        else:
+                            self.assertEqual(field.goal_of(index), DistanceField.UNREACHABLE)
+                # blocks that are not sources leave the field as it is
+                dist = list(field.dist)
+                field.remove_source(rnd.choice(list(world_map.indexes_of(Constants.BLOCK_TYPE_NORMAL))))
+                self.assertEqual(list(field.dist), dist)
+
+
+class TargetAssignmentTest(unittest.TestCase):
+    def score(self, assignment, result, cells):
+        fields = {}
+        total = 0
+        for cell_id, index in cells:
+            if cell_id not in result:
+                continue
+            goal = result[cell_id][0]
+            if goal not in fields:
+                fields[goal] = assignment.field([goal])
+            total += fields[goal].distance(index)
+        return -len(result), total
+
+    def test_exact_never_worse_than_greedy(self):
+        rnd = random.Random(1)
+        improved = 0
+        for seed in range(3):
+            world_map = make_map(30, seed)
+            resources = list(world_map.indexes_of(Constants.BLOCK_TYPE_RESOURCE))
+            walkable = list(world_map.indexes_of(Constants.BLOCK_TYPE_NORMAL))
+            for jump in (1, 3):
+                for i in range(10):
+                    sources = rnd.sample(resources, min(len(resources), rnd.randint(1, 6)))
+                    cells = [(cell_id, index) for cell_id, index in enumerate(rnd.sample(walkable, rnd.randint(2, 8)))]
+                    greedy = TargetAssignment(world_map, jump, sources)
+                    greedy.HUNGARIAN_MAX = 0
+                    greedy_result = greedy.assign(cells)
+                    exact = TargetAssignment(world_map, jump, sources)
+                    result = exact.assign(cells)
+                    goals = [goal for goal, step in result.values()]
+                    self.assertEqual(len(goals), len(set(goals)))
+                    self.assertLessEqual(self.score(exact, result, cells), self.score(exact, greedy_result, cells))
+                    if self.score(exact, result, cells) < self.score(exact, greedy_result, cells):
+                        improved += 1
+        # the two sides really are different solvers
+        self.assertGreater(improved, 0)
+
+    def test_exact_prefers_more_cells_over_shorter_walks(self):
+        rnd = random.Random(2)
+        world_map = make_map(20, 4)
+        resources = list(world_map.indexes_of(Constants.BLOCK_TYPE_RESOURCE))
+        walkable = list(world_map.indexes_of(Constants.BLOCK_TYPE_NORMAL))
+        for i in range(30):
+            sources = rnd.sample(resources, rnd.randint(1, 4))
+            cells = list(enumerate(rnd.sample(walkable, rnd.randint(2, 4))))
+            assignment = TargetAssignment(world_map, 2, sources)
+            fields = {goal: assignment.field([goal]) for goal in sources}
+            # a valid but poor starting point: only the first cell that can reach a goal
+            greedy = {}
+            for cell_id, index in cells:
+                goal = min(sources, key=lambda goal: (fields[goal].distance(index) < 0, fields[goal].distance(index)))
+                if fields[goal].distance(index) >= 0:
+                    greedy[cell_id] = (goal, fields[goal].next_step(index))
+                    break
+            best = None
+            for choice in itertools.product([None] + sources, repeat=len(cells)):
+                picked = [goal for goal in choice if goal is not None]
+                if len(picked) != len(set(picked)):
+                    continue
+                if any(goal is not None and fields[goal].distance(index) < 0
+                       for goal, (cell_id, index) in zip(choice, cells)):
+                    continue
+                score = (-len(picked), sum(fields[goal].distance(index)
+                                           for goal, (cell_id, index) in zip(choice, cells) if goal is not None))
+                if best is None or score < best:
+                    best = score
+            result = assignment.exact(cells, sorted(sources), greedy)
+            self.assertEqual(self.score(assignment, result, cells), best)
+
+
+class ReachabilityTest(unittest.TestCase):
+    def test_matches_search_path(self):
+        rnd = random.Random(3)
+        for seed in range(2):
+            model = make_model(20, seed, impassable=0.25)
+            world = model.world
+            reachability = Reachability()
+            reachability.attach(world)
+            blocks = list(world.map.all_blocks.values())
+            for turn in range(3):
+                for jump in range(5):
+                    # no cells on the map, so the search's occupancy check never applies
+                    cell = SimpleNamespace(id=None, jump=jump)
+                    for i in range(60):
+                        start, end = rnd.choice(blocks), rnd.choice(blocks)
+                        expected = AI.get_next_to_pos(world, cell, start, end) is not None
+                        self.assertEqual(reachability.can_reach(start.index, end.index, jump), expected)
+                statics = [{Constants.GAME_OBJECT_KEY_ID: block.id, Constants.BLOCK_KEY_MIN_HEIGHT: rnd.randint(0, 4)}
+                           for block in rnd.sample(blocks, 5)]
+                statics.append({Constants.GAME_OBJECT_KEY_ID: rnd.choice(blocks).id,
+                                Constants.GAME_OBJECT_KEY_TYPE: rnd.choice([Constants.BLOCK_TYPE_NORMAL,
+                                                                            Constants.BLOCK_TYPE_IMPASSABLE])})
+                model.handle_turn_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_TURN,
+                                           Constants.KEY_ARGS: [turn + 2, {Constants.KEY_STATICS: statics,
+                                                                           Constants.KEY_DYNAMICS: []}]})
+            # repaired every turn, never built again
+            self.assertEqual(reachability.builds, 5)
+
+    def test_repair_matches_rebuild(self):
+        rnd = random.Random(4)
+        model = make_model(16, 2, impassable=0.2)
+        world = model.world
+        reachability = Reachability()
+        reachability.attach(world)
+        for jump in range(Constants.CELL_MAX_JUMP + 1):
+            reachability.level(jump)
+        blocks = list(world.map.all_blocks.values())
+        for turn in range(40):
+            statics = []
+            for block in rnd.sample(blocks, rnd.randint(1, 12)):
+                data = {Constants.GAME_OBJECT_KEY_ID: block.id}
+                if rnd.random() < 0.2:
+                    data[Constants.GAME_OBJECT_KEY_TYPE] = rnd.choice([Constants.BLOCK_TYPE_NORMAL,
+                                                                       Constants.BLOCK_TYPE_IMPASSABLE])
+                else:
+                    data[Constants.BLOCK_KEY_MIN_HEIGHT] = rnd.randint(0, 6)
+                statics.append(data)
+            model.handle_turn_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_TURN,
+                                       Constants.KEY_ARGS: [turn + 2, {Constants.KEY_STATICS: statics,
+                                                                       Constants.KEY_DYNAMICS: []}]})
+            for jump, components in reachability.levels.items():
+                fresh = Components(world.map.adjacent, reachability.heights, reachability.walkable, jump)
+                self.assertEqual(sorted(sorted(group) for group in components.members if group),
+                                 sorted(sorted(group) for group in fresh.members if group))
+                component = components.component
+                for index, group in enumerate(components.successors):
+                    if group is None:
+                        continue
+                    for target in group:
+                        self.assertLess(components.position[index], components.position[target])
+                for i in range(30):
+                    start, end = rnd.choice(blocks).index, rnd.choice(blocks).index
+                    if component[start] >= 0 and component[end] >= 0:
+                        self.assertEqual(components.reachable(component[start]) >> component[end] & 1,
+                                         fresh.reachable(fresh.component[start]) >> fresh.component[end] & 1)
+        self.assertEqual(reachability.builds, Constants.CELL_MAX_JUMP + 1)
+
+
+class PathCacheTest(unittest.TestCase):
+    def test_block_changes_keep_what_still_holds(self):
+        rnd = random.Random(5)
+        model = make_model(20, 1, impassable=0.25)
+        world = model.world
+        cache = PathCache()
+        cache.attach(world)
+        blocks = list(world.map.all_blocks.values())
+        for jump in range(Constants.CELL_MAX_JUMP + 1):
+            cell = SimpleNamespace(id=None, jump=jump)
+            for i in range(40):
+                start, end = rnd.sample(blocks, 2)
+                cache.put((start.index, end.index, jump), start.index,
+                          PathSearch(world, cell).a_star(start.index, end.index))
+
+        def turn(number, statics):
+            model.handle_turn_message({Constants.KEY_NAME: Constants.MESSAGE_TYPE_TURN,
+                                       Constants.KEY_ARGS: [number, {Constants.KEY_STATICS: statics,
+                                                                     Constants.KEY_DYNAMICS: []}]})
+
+        # blocks sent again as they are change nothing
+        entries = dict(cache.entries)
+        turn(2, [{Constants.GAME_OBJECT_KEY_ID: block.id, Constants.GAME_OBJECT_KEY_TYPE: block.type,
+                  Constants.BLOCK_KEY_MIN_HEIGHT: block.min_height} for block in blocks])
+        self.assertEqual(cache.entries, entries)
+        kept = 0
+        for number in range(3, 40):
+            statics = []
+            for block in rnd.sample(blocks, 3):
+                data = {Constants.GAME_OBJECT_KEY_ID: block.id}
+                if rnd.random() < 0.3:
+                    data[Constants.GAME_OBJECT_KEY_TYPE] = rnd.choice([Constants.BLOCK_TYPE_NORMAL,
+                                                                       Constants.BLOCK_TYPE_IMPASSABLE])
+                else:
+                    data[Constants.BLOCK_KEY_MIN_HEIGHT] = rnd.randint(0, 6)
+                statics.append(data)
+            unreachable = set(cache.unreachable)
+            turn(number, statics)
+            kept += len(unreachable & cache.unreachable)
+            for (start, end, jump), path in cache.entries.items():
+                cell = SimpleNamespace(id=None, jump=jump)
+                found = PathSearch(world, cell).a_star(start, end)
+                self.assertEqual(path is None, found is None)
+        self.assertGreater(kept, 0)
+
+
+class ParallelPlannerTest(unittest.TestCase):
+    def test_worker_errors_are_reported(self):
+        model = make_model(12, 0)
+        planner = ParallelPlanner(1)
+        try:
+            errors = io.StringIO()
+            with redirect_stderr(errors):
+                # a block index past the map makes the worker raise
+                plans = planner.plan(model.world, [(1, 12 * 12 + 5, 1, 10, Constants.BLOCK_TYPE_RESOURCE)])
+            self.assertEqual(plans, {})
+            self.assertIn("IndexError", errors.getvalue())
+            plans = planner.plan(model.world, [(1, 0, 1, 10, Constants.BLOCK_TYPE_RESOURCE)])
+            self.assertEqual(list(plans), [1])
+        finally:
+            planner.close()
+
+
+if __name__ == "__main__":
+    unittest.main()